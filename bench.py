@@ -0,0 +1,312 @@
+# bench.py (Micro-benchmarks for the server-side hot paths)
+import argparse
+import hashlib
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import shared_logic
+import server1
+from transaction_store import TransactionStore
+
+
+def random_words(num_entries):
+    return np.random.randint(0, 2 ** 32, size=num_entries, dtype=np.uint64).astype(np.uint32)
+
+
+def layout_shape(words, entry_len, prefix_bits):
+    counts = np.bincount(words >> np.uint32(32 - prefix_bits))
+    return int(np.count_nonzero(counts)), int(counts.max())
+
+
+def synthetic_db_matrix(num_entries, entry_len=32):
+    # Same shape partition_db_by_prefix would produce for num_entries uniformly random hashes.
+    words = random_words(num_entries)
+    num_rows, max_cols_per_row = layout_shape(words, entry_len, shared_logic.choose_prefix_bits(words, entry_len))
+    return np.random.randint(0, shared_logic.LWE_P, size=(num_rows, max_cols_per_row * entry_len), dtype=np.uint8)
+
+
+def bench_layout(args):
+    # DB shape and padding for the old fixed 16-bit prefix against the width choose_prefix_bits picks.
+    print(f"{'entries':>10} {'bits':>5} {'rows':>8} {'row_width':>10} {'padding':>8} {'cells':>14}")
+    for num_entries in args.entries:
+        words = random_words(num_entries)
+        for prefix_bits in (16, shared_logic.choose_prefix_bits(words, args.hash_len)):
+            num_rows, max_cols_per_row = layout_shape(words, args.hash_len, prefix_bits)
+            padding = server1.padding_ratio(num_entries, num_rows, max_cols_per_row)
+            print(f"{num_entries:>10} {prefix_bits:>5} {num_rows:>8} {max_cols_per_row * args.hash_len:>10} "
+                  f"{padding:>8.1%} {num_rows * max_cols_per_row * args.hash_len:>14}")
+
+
+def bench_batch(args):
+    db_matrix = synthetic_db_matrix(args.entries)
+    print(f"db_matrix: {db_matrix.shape[0]} x {db_matrix.shape[1]} ({db_matrix.nbytes / 2 ** 20:.1f} MiB)")
+    print(f"{'k':>4} {'seconds':>10} {'queries/s':>12} {'speedup':>8}")
+    base_qps = None
+    k = 1
+    while k <= args.max_k:
+        qu_matrix = np.random.randint(0, shared_logic.LWE_Q, size=(k, db_matrix.shape[0]), dtype=np.uint32)
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            server1.compute_answers(qu_matrix, db_matrix)
+            best = min(best, time.perf_counter() - start)
+        qps = k / best
+        base_qps = base_qps or qps
+        print(f"{k:>4} {best:>10.4f} {qps:>12.2f} {qps / base_qps:>7.2f}x")
+        k *= 2
+
+
+def bench_workers(args):
+    db_matrix = synthetic_db_matrix(args.entries)
+    lwe_seed = shared_logic.generate_lwe_seed()
+    qu_matrix = np.random.randint(0, shared_logic.LWE_Q, size=(1, db_matrix.shape[0]), dtype=np.uint32)
+    client = server1.app.test_client()
+    print(f"db_matrix: {db_matrix.shape[0]} x {db_matrix.shape[1]}, chunk_size={args.chunk_size}")
+    print(f"{'workers':>7} {'answer_s':>10} {'hint_s':>10}")
+    workers = 1
+    while workers <= args.max_workers:
+        client.post('/config', json={'workers': workers, 'chunk_size': args.chunk_size})
+        start = time.perf_counter()
+        server1.compute_answers(qu_matrix, db_matrix)
+        answer_time = time.perf_counter() - start
+        start = time.perf_counter()
+        server1.compute_hint(lwe_seed, db_matrix)
+        print(f"{workers:>7} {answer_time:>10.4f} {time.perf_counter() - start:>10.4f}")
+        workers *= 2
+
+
+def legacy_partition_db_by_prefix(db_hashes):
+    # partition_db_by_prefix as it was before vectorization, kept for before/after timings.
+    groups = defaultdict(list)
+    prefix_bits = shared_logic.choose_prefix_bits(shared_logic.leading_words(shared_logic.hashes_to_array(db_hashes)),
+                                                  len(db_hashes[0]))
+    for h in db_hashes:
+        groups[shared_logic.get_prefix_from_hash(h, prefix_bits)].append(h)
+    prefix_list = sorted(groups.keys())
+    max_cols_per_row = max(len(items) for items in groups.values())
+    num_cols = max_cols_per_row * len(db_hashes[0])
+    db_matrix = np.zeros((len(prefix_list), num_cols), dtype=np.uint8)
+    for i, prefix in enumerate(prefix_list):
+        row_vec = np.array([], dtype=np.uint8)
+        for item_bytes in groups[prefix]:
+            row_vec = np.concatenate([row_vec, shared_logic.bytes_to_int_array(item_bytes)])
+        padding = np.random.randint(0, shared_logic.LWE_P, size=num_cols - len(row_vec), dtype=np.uint8)
+        db_matrix[i, :] = np.concatenate([row_vec, padding])
+    return db_matrix, [p.hex() for p in prefix_list]
+
+
+def bench_partition(args):
+    print(f"{'entries':>10} {'legacy_s':>10} {'vectorized_s':>13} {'speedup':>8}")
+    for num_entries in args.entries:
+        hash_array = np.random.randint(0, 256, size=(num_entries, args.hash_len), dtype=np.uint8)
+        db_hashes = [bytes(row) for row in hash_array]
+        start = time.perf_counter()
+        db_matrix, prefix_list, db_params = server1.partition_db_by_prefix(db_hashes)
+        vectorized_time = time.perf_counter() - start
+        legacy_time = float('nan')
+        if num_entries <= args.legacy_max:
+            start = time.perf_counter()
+            legacy_matrix, legacy_prefixes = legacy_partition_db_by_prefix(db_hashes)
+            legacy_time = time.perf_counter() - start
+            # Same rows and same items in the same slots; only the random padding differs.
+            counts = np.unique(shared_logic.prefix_values(hash_array, db_params['prefix_bits']), return_counts=True)[1]
+            filled = np.arange(db_params['max_cols_per_row']) < counts[:, None]
+            slots = (len(prefix_list), db_params['max_cols_per_row'], args.hash_len)
+            assert legacy_prefixes == prefix_list
+            assert np.array_equal(legacy_matrix.reshape(slots)[filled], db_matrix.reshape(slots)[filled])
+        print(f"{num_entries:>10} {legacy_time:>10.2f} {vectorized_time:>13.2f} {legacy_time / vectorized_time:>7.1f}x")
+
+
+def bench_oprf(args):
+    # Items/s for Server2's batch evaluation (cold, then with every item cached as for a repeated row), the
+    # client's blind + unblind, and the full blind -> evaluate -> unblind round trip checked against it.
+    items = np.random.randint(0, 256, size=(args.items, args.hash_len), dtype=np.uint8)
+    sk_oprf = shared_logic.oprf_generate_key()
+    cache = {}
+    def cached_eval(item):
+        if item not in cache: cache[item] = shared_logic.oprf_server_eval_on_item(item, sk_oprf)
+        return cache[item]
+    timings = {}
+    start = time.perf_counter()
+    server_values = shared_logic.oprf_server_eval_batch(items, sk_oprf, eval_item=cached_eval)
+    timings['server eval (cold)'] = time.perf_counter() - start
+    start = time.perf_counter()
+    shared_logic.oprf_server_eval_batch(items, sk_oprf, eval_item=cached_eval)
+    timings['server eval (cached)'] = time.perf_counter() - start
+    start = time.perf_counter()
+    blinded, factors = shared_logic.oprf_blind_batch([item.tobytes() for item in items])
+    timings['client blind'] = time.perf_counter() - start
+    evaluated = shared_logic.oprf_evaluate_batch(blinded, sk_oprf)
+    start = time.perf_counter()
+    client_values = shared_logic.oprf_unblind_batch(evaluated, factors)
+    timings['client unblind'] = time.perf_counter() - start
+    assert client_values == server_values
+    for name, seconds in timings.items():
+        print(f"{name:>22}: {args.items / seconds:>12.0f} items/s")
+
+
+def bench_kernels(args):
+    # Timing only; tests/test_kernels.py checks the kernels against shared_logic.reference_matmul_mod_q.
+    rng = np.random.default_rng(args.seed)
+    vec = rng.integers(0, shared_logic.LWE_Q, size=shared_logic.LWE_N, dtype=np.uint64).astype(np.uint32)
+    hint = rng.integers(0, shared_logic.LWE_Q, size=(shared_logic.LWE_N, args.cols), dtype=np.uint64).astype(np.uint32)
+    for name, fn in (("int64 reference", lambda: shared_logic.reference_matmul_mod_q(vec.reshape(1, -1), hint)),
+                     ("matvec_mod_q", lambda: shared_logic.matvec_mod_q(vec, hint))):
+        start = time.perf_counter()
+        fn()
+        print(f"s @ hint ({shared_logic.LWE_N} x {args.cols}) {name}: {time.perf_counter() - start:.4f}s")
+
+
+def bench_expand(args):
+    lwe_seed = shared_logic.generate_lwe_seed()
+    s = np.random.randint(0, shared_logic.LWE_Q, size=shared_logic.LWE_N, dtype=np.uint32)
+    start = time.perf_counter()
+    for _ in shared_logic.iter_lwe_matrix_A_blocks(lwe_seed, args.rows): pass
+    expand_time = time.perf_counter() - start
+    start = time.perf_counter()
+    shared_logic.seeded_vec_times_A(lwe_seed, s, args.rows)
+    sA_time = time.perf_counter() - start
+    mib = shared_logic.LWE_N * args.rows * 4 / 2 ** 20
+    print(f"A: {shared_logic.LWE_N} x {args.rows} ({mib:.0f} MiB as uint32) from a {shared_logic.LWE_SEED_BYTES}-byte seed")
+    print(f"expand only: {expand_time:.3f}s ({mib / expand_time:.0f} MiB/s); streamed s @ A: {sA_time:.3f}s")
+
+
+def legacy_generate_hash_database(num_entries, hash_len_bytes):
+    db_hashes = set()
+    while len(db_hashes) < num_entries:
+        db_hashes.add(hashlib.sha256(os.urandom(32)).digest()[:hash_len_bytes])
+    return list(db_hashes)
+
+
+def measure(fn):
+    # Wall time and Python-heap peak of fn(); numpy buffers are traced too, memory-mapped pages are not.
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_items(args):
+    # Generating the database, then loading it as Server1's /preprocess does: the JSON hex list against
+    # the memory-mapped .npy item file. Clients now read QUERY_SAMPLE_SIZE records instead of the whole list.
+    print(f"{'entries':>10} {'step':>10} {'legacy_s':>10} {'legacy_MiB':>11} {'new_s':>9} {'new_MiB':>9} "
+          f"{'time_x':>8} {'mem_x':>8}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_entries in args.entries:
+            hashes, new_s, new_peak = measure(lambda: shared_logic.generate_hash_database(num_entries, args.hash_len))
+            if num_entries <= args.legacy_max:
+                _, legacy_s, legacy_peak = measure(lambda: legacy_generate_hash_database(num_entries, args.hash_len))
+                print(f"{num_entries:>10} {'generate':>10} {legacy_s:>10.3f} {legacy_peak / 2 ** 20:>11.1f} "
+                      f"{new_s:>9.3f} {new_peak / 2 ** 20:>9.1f} {legacy_s / new_s:>7.1f}x "
+                      f"{legacy_peak / max(new_peak, 1):>7.1f}x")
+            json_path, npy_path = os.path.join(tmp_dir, 'db.json'), os.path.join(tmp_dir, 'db.npy')
+            with open(json_path, 'w') as f: json.dump([h.tobytes().hex() for h in hashes], f)
+            shared_logic.save_hash_file(npy_path, hashes)
+            del hashes
+            _, legacy_s, legacy_peak = measure(lambda: shared_logic.load_hash_file(json_path))
+            _, new_s, new_peak = measure(lambda: shared_logic.load_hash_file(npy_path))
+            print(f"{num_entries:>10} {'load':>10} {legacy_s:>10.3f} {legacy_peak / 2 ** 20:>11.1f} {new_s:>9.3f} "
+                  f"{new_peak / 2 ** 20:>9.3f} {legacy_s / new_s:>7.0f}x {legacy_peak / max(new_peak, 1):>7.0f}x")
+            print(f"{num_entries:>10} {'download':>10} json {os.path.getsize(json_path) / 2 ** 20:.1f}MiB, "
+                  f"item file {os.path.getsize(npy_path) / 2 ** 20:.1f}MiB, "
+                  f"sample of {args.sample} {args.sample * args.hash_len / 2 ** 10:.0f}KiB")
+
+
+def soak_transaction(store, s, ans, orphan):
+    # One query's life on Server2: s and ans arrive, verification frees them, the filter is downloaded.
+    transaction_id = str(uuid.uuid4())
+    store.put(transaction_id, 's', s.copy())
+    if orphan: return  # ans never arrives; only the TTL or the byte budget can reclaim the entry
+    store.put(transaction_id, 'ans', ans.copy())
+    if not store.wait_for(transaction_id, ('s', 'ans'), timeout=1): return
+    with store.lock(transaction_id):
+        store.discard(transaction_id, 's', 'ans')
+        store.update(transaction_id, {'decryption_time': 0.0, 'bloom_gen_time': 0.0, 'membership_filter': bytes(88),
+                                      'recovered_items_hex': ['00' * 32] * 4})
+    store.pop(transaction_id, 'membership_filter')
+
+
+def bench_soak(args):
+    # Throughput and memory under load; tests/test_transaction_store.py checks the byte budget and TTL.
+    store = TransactionStore(ttl=args.ttl, max_bytes=args.max_bytes)
+    s = np.zeros(shared_logic.LWE_N, dtype=np.uint32)
+    ans = np.zeros(args.cols, dtype=np.uint32)
+    peak_bytes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        for done in range(0, args.transactions, args.report_every):
+            batch = min(args.report_every, args.transactions - done)
+            orphans = np.random.random(batch) < args.orphan_rate
+            list(pool.map(lambda orphan: soak_transaction(store, s, ans, orphan), orphans))
+            stats = store.stats()
+            peak_bytes = max(peak_bytes, stats['bytes_held'])
+            rss_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            elapsed = time.perf_counter() - start
+            print(f"{done + batch:>8} transactions {elapsed:>7.1f}s  live={stats['live_entries']:>6} "
+                  f"held={stats['bytes_held'] / 2 ** 20:>7.1f}MiB evictions={stats['evictions']:>6} "
+                  f"expirations={stats['expirations']:>6} max_rss={rss_mib:.0f}MiB")
+    print(f"peak held {peak_bytes / 2 ** 20:.1f}MiB of a {args.max_bytes / 2 ** 20:.1f}MiB budget")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="PIR micro-benchmarks")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('batch', help="queries/s of /compute-answer-batch's kernel as k goes 1..max-k")
+    p.add_argument('--entries', type=int, default=10 ** 6)
+    p.add_argument('--max-k', type=int, default=64)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_batch)
+    p = sub.add_parser('workers', help="answer and hint time as the Server1 worker pool grows")
+    p.add_argument('--entries', type=int, default=10 ** 6)
+    p.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    p.add_argument('--chunk-size', type=int, default=server1.CHUNK_SIZE)
+    p.set_defaults(func=bench_workers)
+    p = sub.add_parser('partition', help="partition_db_by_prefix time, vectorized vs the old per-item loop")
+    p.add_argument('--entries', type=int, nargs='+', default=[10 ** 6, 10 ** 7])
+    p.add_argument('--hash-len', type=int, default=32)
+    p.add_argument('--legacy-max', type=int, default=10 ** 7, help="skip the old loop above this size")
+    p.set_defaults(func=bench_partition)
+    p = sub.add_parser('layout', help="DB shape and padding, fixed 16-bit prefix vs the adaptive prefix width")
+    p.add_argument('--entries', type=int, nargs='+', default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7])
+    p.add_argument('--hash-len', type=int, default=32)
+    p.set_defaults(func=bench_layout)
+    p = sub.add_parser('expand', help="seed expansion rate of A and the streamed client s @ A")
+    p.add_argument('--rows', type=int, default=65536)
+    p.set_defaults(func=bench_expand)
+    p = sub.add_parser('kernels', help="time s @ hint, the int64 reference against matvec_mod_q")
+    p.add_argument('--cols', type=int, default=6720)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_kernels)
+    p = sub.add_parser('oprf', help="P-256 OPRF throughput in items/s, server batch and client blind/unblind")
+    p.add_argument('--items', type=int, default=5000)
+    p.add_argument('--hash-len', type=int, default=32)
+    p.set_defaults(func=bench_oprf)
+    p = sub.add_parser('items', help="database generation and load, JSON hex list vs the memory-mapped item file")
+    p.add_argument('--entries', type=int, nargs='+', default=[10 ** 6, 10 ** 7])
+    p.add_argument('--hash-len', type=int, default=32)
+    p.add_argument('--legacy-max', type=int, default=10 ** 6, help="skip the old generator above this size")
+    p.add_argument('--sample', type=int, default=4096, help="items a client samples")
+    p.set_defaults(func=bench_items)
+    p = sub.add_parser('soak', help="transactions/s through Server2's TransactionStore and its memory over time")
+    p.add_argument('--transactions', type=int, default=100000)
+    p.add_argument('--threads', type=int, default=16)
+    p.add_argument('--cols', type=int, default=6720, help="length of each ans vector")
+    p.add_argument('--orphan-rate', type=float, default=0.05, help="fraction of transactions whose ans never arrives")
+    p.add_argument('--ttl', type=float, default=2.0)
+    p.add_argument('--max-bytes', type=int, default=64 * 2 ** 20)
+    p.add_argument('--report-every', type=int, default=10000)
+    p.set_defaults(func=bench_soak)
+    args = parser.parse_args()
+    args.func(args)
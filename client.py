@@ -4,12 +4,19 @@ import requests
 import time
 import pandas as pd
 import uuid
-from pybloom_live import BloomFilter
 import random
 import hashlib
 import os
 import json
+import csv
+import argparse
+import subprocess
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 import shared_logic
+from query_pool import QueryMaterialPool, mask_to_query
 
 S1_IP = ""
 S2_IP = ""
@@ -20,94 +27,338 @@ S2_URL = f"http://{S2_IP}:{S2_PORT}"
 
 DATABASE_SIZES = [10 ** 7]
 HASH_LEN_BYTES = 
-A_FILE = "lwe_matrix_A.npy"
-BF_FILE_NAME_TEMPLATE = "bf_{}.bin"
-QUERYABLE_ITEMS_FILE = "queryable_hashes.json"
+# Queryable items are sampled from Server1's fixed-width item file: QUERY_SAMPLE_SIZE items read as
+# QUERY_SAMPLE_WINDOWS contiguous byte ranges at random offsets. None downloads every item.
+QUERY_SAMPLE_SIZE = 4096
+QUERY_SAMPLE_WINDOWS = 16
+# Bytes requested first to read the item file's header (numpy pads it to a multiple of 64 bytes).
+ITEMS_HEADER_PROBE = 4096
+# Bit width for qu and s on the wire; None sends raw little-endian uint32 words.
+WIRE_BITS = shared_logic.LWE_Q_BITS
+# Per-query progress output; the benchmark turns it off so many virtual clients don't flood the console.
+VERBOSE = True
+# Membership filter requested from Server2: 'fingerprint' or 'bloom', and its false-positive rate.
+MEMBERSHIP_FILTER_KIND = 'fingerprint'
+MEMBERSHIP_FP_RATE = 1e-9
+# Bump when the benchmark CSV/JSON layout changes, so results from different commits stay comparable.
+BENCH_SCHEMA_VERSION = 1
+BENCH_CSV_FIELDS = ['schema_version', 'git_commit', 'db_size', 'hash_len', 'clients', 'kind', 'name',
+                    'count', 'mean', 'p50', 'p95', 'p99']
 
 DB_PARAMS = {}
+LWE_SEED = None
 QUERYABLE_HASHES = []
+OT_CACHE = {'epoch': None, 'etag': None, 'tags': None, 'table': None}
 
-def run_single_query():
+# (s, sA + e) pairs generated in the background so a query only adds Δ at its target row; 0 disables.
+PRECOMPUTE_POOL_SIZE = 64
+QUERY_POOL = QueryMaterialPool(PRECOMPUTE_POOL_SIZE)
+
+# How long a query keeps polling /setup-verification while Server2 answers 408 (s or ans not in yet) or 503 (too
+# many requests already waiting), and the pause before retrying after a 503.
+VERIFICATION_TIMEOUT = 30
+VERIFICATION_BUSY_DELAY = 0.05
+
+# Also returned when the prefix was added by an /update this client has not seen yet.
+OT_MISS_ERROR = "OT failed: Query item's prefix not found."
+
+# Requests one in-flight query holds on Server2 at once: /receive-s, /setup-verification and the OPRF call.
+S2_REQUESTS_PER_CLIENT = 3
+
+# One keep-alive connection pool shared by every query, and the threads that drive it for the async client.
+HTTP_POOL_SIZE = 16
+SESSION = requests.Session()
+EXECUTOR = None
+
+def configure_http_pool(pool_size):
+    global EXECUTOR
+    SESSION.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=pool_size))
+    if EXECUTOR is not None: EXECUTOR.shutdown(wait=False)
+    EXECUTOR = ThreadPoolExecutor(max_workers=pool_size)
+
+configure_http_pool(HTTP_POOL_SIZE)
 
-    global DB_PARAMS, QUERYABLE_HASHES
-    LWE_A = np.load(A_FILE)
-    target_hash_hex = random.choice(QUERYABLE_HASHES)
-    target_hash = bytes.fromhex(target_hash_hex)
+def fetch_ot_table():
+    # Downloads the OT lookup table at most once per preprocessing epoch; returns bytes transferred.
+    if OT_CACHE['epoch'] is not None and OT_CACHE['epoch'] == DB_PARAMS.get('epoch'):
+        return 0
+    headers = {'If-None-Match': OT_CACHE['etag']} if OT_CACHE['etag'] else {}
+    resp_ot = SESSION.get(f"{S1_URL}/ot-table", headers=headers)
+    if resp_ot.status_code == 304:
+        OT_CACHE['epoch'] = DB_PARAMS.get('epoch')
+        return 0
+    resp_ot.raise_for_status()
+    tags, table, meta = shared_logic.load_ot_table(resp_ot.content)
+    # The table is only rebuilt when rows are added, so its own epoch can trail DB_PARAMS['epoch'].
+    OT_CACHE.update({'epoch': DB_PARAMS.get('epoch', meta['epoch']), 'etag': resp_ot.headers.get('ETag'),
+                     'tags': tags, 'table': table})
+    return len(resp_ot.content)
+
+def post_vector(url, vec, meta):
+    body = shared_logic.encode_array(vec, meta, dtype=np.uint32, bits=WIRE_BITS)
+    response = SESSION.post(url, data=body, headers={'Content-Type': shared_logic.WIRE_CONTENT_TYPE})
+    response.raise_for_status()
+    return response, len(body) + len(response.content)
+
+def prepare_query(target_hash):
     transaction_id = str(uuid.uuid4())
-    print(f"\n--- [{transaction_id}] Running Query: Target Hash='{target_hash.hex()}' ---")
-    metrics = {"db_size": DB_PARAMS['num_entries'], "entry_len": HASH_LEN_BYTES}
+    if VERBOSE: print(f"\n--- [{transaction_id}] Running Query: Target Hash='{target_hash.hex()}' ---")
+    metrics = {"db_size": DB_PARAMS['num_entries'], "entry_len": DB_PARAMS['entry_vec_len']}
     start_time_ot = time.time()
     try:
-        resp_ot = requests.get(f"{S1_URL}/ot-setup");
-        resp_ot.raise_for_status()
-        encrypted_list = resp_ot.json()['encrypted_index_list']
+        metrics['comm_ot_bytes'] = fetch_ot_table()
     except requests.exceptions.RequestException as e:
         return None, f"OT setup failed: {e}"
-    my_prefix = shared_logic.get_prefix_from_hash(target_hash)
+    my_prefix = shared_logic.get_prefix_from_hash(target_hash, DB_PARAMS['prefix_bits'])
     my_key = shared_logic.get_key_from_prefix(my_prefix)
-    target_row_b = next((shared_logic.decrypt_index(my_key, token) for token in encrypted_list if
-                         shared_logic.decrypt_index(my_key, token) is not None), None)
-    if target_row_b is None: return None, "OT failed: Query item's prefix not found."
+    target_row_b = shared_logic.lookup_ot_index(OT_CACHE['tags'], OT_CACHE['table'], my_key)
+    if target_row_b is None: return None, OT_MISS_ERROR
     metrics['time_ot'] = time.time() - start_time_ot
-    print(f"OT成功, 找到行索引: {target_row_b}")
-    start_time_qgen = time.time()
-    s = np.random.randint(0, shared_logic.LWE_Q, size=shared_logic.LWE_N, dtype=np.uint32)
-    e = shared_logic.generate_noise_vector(DB_PARAMS['num_rows'])
-    u_b = np.zeros(DB_PARAMS['num_rows'], dtype=np.int64);
-    u_b[target_row_b] = 1
-    sA = s.astype(np.int64) @ LWE_A.astype(np.int64) % shared_logic.LWE_Q
-    qu = (sA + e + shared_logic.SCALING_FACTOR * u_b) % shared_logic.LWE_Q
-    metrics['time_query_gen'] = time.time() - start_time_qgen
+    if VERBOSE: print(f"OT成功, 找到行索引: {target_row_b}")
+    start_time_qgen = time.perf_counter()
+    s, masked = QUERY_POOL.take(LWE_SEED, DB_PARAMS['num_rows'])
+    qu = mask_to_query(masked, target_row_b)
+    metrics['time_query_gen'] = time.perf_counter() - start_time_qgen
+    return (transaction_id, s, qu, metrics), None
+
+def post_json(url, payload):
+    body = json.dumps(payload)
+    response = SESSION.post(url, data=body, headers={'Content-Type': 'application/json'})
+    response.raise_for_status()
+    return response, len(body) + len(response.content)
+
+def send_s(transaction_id, s, metrics):
+    start_time = time.time()
+    _, metrics['comm_s_bytes'] = post_vector(f"{S2_URL}/receive-s", s, {'transaction_id': transaction_id})
+    metrics['time_send_s'] = time.time() - start_time
+
+def send_qu(transaction_id, qu, metrics):
+    start_time = time.time()
     try:
-        requests.post(f"{S2_URL}/receive-s", json={'s': s.tolist(), 'transaction_id': transaction_id})
-        response_s1 = requests.post(f"{S1_URL}/compute-answer",
-                                    json={'qu': qu.tolist(), 'transaction_id': transaction_id})
-        metrics['time_s1_computation'] = response_s1.json()['core_computation_time']
-        time.sleep(1)
-    except requests.exceptions.RequestException as e:
-        return None, f"Failed to connect during computation: {e}"
-    start_time_verify = time.time();
-    bf = None
+        response_s1, metrics['comm_qu_bytes'] = post_vector(f"{S1_URL}/compute-answer", qu, {
+            'transaction_id': transaction_id, 'epoch': DB_PARAMS.get('epoch')})
+    except requests.exceptions.RequestException:
+        # Whatever went wrong (stale epoch, full forward queue, failed shard), no ans is on its way to Server2,
+        # so release the verification request waiting for it rather than let it hold a thread until it times out.
+        try:
+            SESSION.post(f"{S2_URL}/abort-transaction/{transaction_id}", timeout=5)
+        except requests.exceptions.RequestException:
+            pass
+        raise
+    metrics['time_s1_request'] = time.time() - start_time
+    metrics['time_s1_computation'] = response_s1.json()['core_computation_time']
+    metrics['comm_ans_bytes'] = response_s1.json().get('ans_bytes', 0)
+
+def fetch_verification(transaction_id, metrics):
+    # Server2 holds /setup-verification briefly until both s and ans have arrived, so this can be sent
+    # alongside them instead of after a fixed sleep; a 408 or 503 means ask again.
+    start_time = time.time()
+    deadline = start_time + VERIFICATION_TIMEOUT
+    payload = {'transaction_id': transaction_id, 'db_params': DB_PARAMS, 'filter_kind': MEMBERSHIP_FILTER_KIND,
+               'fp_rate': MEMBERSHIP_FP_RATE}
+    metrics['comm_setup_verification_bytes'] = 0
+    while True:
+        try:
+            resp_s2_setup, comm_bytes = post_json(f"{S2_URL}/setup-verification", payload)
+            metrics['comm_setup_verification_bytes'] += comm_bytes
+            break
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status not in (408, 503) or time.time() >= deadline: raise
+            if status == 503: time.sleep(VERIFICATION_BUSY_DELAY)
+    metrics['time_setup_verification'] = time.time() - start_time
+    metrics.update({f'time_s2_{k}': v for k, v in resp_s2_setup.json()['s2_metrics'].items()})
+    start_time_bf_dl = time.time()
+    resp_bf = SESSION.get(f"{S2_URL}/download-bf/{transaction_id}")
+    resp_bf.raise_for_status()
+    metrics['time_bf_download'] = time.time() - start_time_bf_dl
+    metrics['comm_bf_bytes'] = len(resp_bf.content)
+    # Not sent: how much smaller the filter is than the 1e-9 pybloom_live filter Server2 used to write to disk.
+    bloom_bytes = shared_logic.decode_array(resp_bf.content)[1]['bloom_bytes']
+    metrics['comm_bf_saved_bytes'] = bloom_bytes - len(resp_bf.content)
+    return resp_bf.content
+
+def oprf_query(transaction_id, target_hash, metrics):
+    start_time = time.time()
+    element = shared_logic.hash_to_group_element(target_hash)
+    blinded_element, blinding_factor = shared_logic.oprf_blind(element)
+    resp_s2_eval, metrics['comm_oprf_bytes'] = post_json(
+        f"{S2_URL}/oprf-interactive-eval", {'transaction_id': transaction_id, 'blinded_element': blinded_element})
+    final_oprf_value = shared_logic.oprf_unblind(resp_s2_eval.json()['evaluated_element'], blinding_factor)
+    metrics['time_oprf'] = time.time() - start_time
+    metrics['time_s2_oprf_eval_time'] = resp_s2_eval.json()['s2_metrics']['oprf_eval_time']
+    return final_oprf_value
+
+def finish_query(transaction_id, membership_filter, final_oprf_value, metrics, start_time):
+    start_time_check = time.time()
+    is_present = shared_logic.membership_filter_contains(membership_filter, final_oprf_value)
+    metrics['time_membership_check'] = time.time() - start_time_check
+    metrics['verified'] = int(is_present)
+    if VERBOSE or not is_present: print(f"[{transaction_id}] 查询结果验证: {'成功' if is_present else '失败'}")
+    if not is_present: print("Verification failed unexpectedly.")
+    if VERBOSE:
+        stages = ", ".join(f"{k[5:]}={v * 1000:.1f}" for k, v in metrics.items() if k.startswith('time_'))
+        print(f"[{transaction_id}] 各阶段耗时(ms): {stages}")
+    # Stages overlap, so the total is wall-clock latency rather than the sum of the stages.
+    metrics['time_online_total'] = time.time() - start_time
+    metrics['comm_online_total_bytes'] = sum([v for k, v in metrics.items()
+                                              if k.startswith('comm_') and k != 'comm_bf_saved_bytes'])
+    return metrics, None
+
+def verify_query(transaction_id, target_hash, metrics, start_time):
     try:
-        resp_s2_setup = requests.post(f"{S2_URL}/setup-verification",
-                                      json={'transaction_id': transaction_id, 'db_params': DB_PARAMS})
-        bf_download_url = f"{S2_URL}/download-bf/{transaction_id}";
-        bf_file_name = BF_FILE_NAME_TEMPLATE.format(transaction_id)
-        start_time_bf_dl = time.time()
-        with requests.get(bf_download_url, stream=True) as r:
-            r.raise_for_status()
-            with open(bf_file_name, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192): f.write(chunk)
-        metrics['time_bf_download'] = time.time() - start_time_bf_dl
-        metrics['comm_bf_bytes'] = os.path.getsize(bf_file_name)
-        with open(bf_file_name, "rb") as f:
-            bf = BloomFilter.fromfile(f)
-        os.remove(bf_file_name)
-        element = shared_logic.hash_to_group_element(target_hash)
-        blinded_element, blinding_factor = shared_logic.oprf_blind(element)
-        resp_s2_eval = requests.post(f"{S2_URL}/oprf-interactive-eval",
-                                     json={'transaction_id': transaction_id, 'blinded_element': blinded_element})
-        evaluated_element = resp_s2_eval.json()['evaluated_element']
-        final_oprf_value = shared_logic.oprf_unblind(evaluated_element, blinding_factor)
-        is_present = final_oprf_value in bf
+        membership_filter = fetch_verification(transaction_id, metrics)
+        final_oprf_value = oprf_query(transaction_id, target_hash, metrics)
     except Exception as e:
         return None, f"S2 verification failed: {e}"
-    finally:
-        temp_bf_path = BF_FILE_NAME_TEMPLATE.format(transaction_id)
-        if os.path.exists(temp_bf_path): os.remove(temp_bf_path)
-    s2_metrics = resp_s2_eval.json()['s2_metrics'];
-    metrics.update({f'time_s2_{k}': v for k, v in s2_metrics.items()})
-    metrics['time_client_verification'] = (time.time() - start_time_verify) - metrics.get('time_bf_download', 0) - sum(
-        s2_metrics.values())
-    print(f"[{transaction_id}] 查询结果验证: {'成功' if is_present else '失败'}")
-    if not is_present: print("Verification failed unexpectedly.")
-    metrics['time_online_total'] = sum([v for k, v in metrics.items() if k.startswith('time_')])
-    metrics['comm_online_total_bytes'] = len(str(qu.tolist())) + len(str(s.tolist())) + len(str(blinded_element)) + len(
-        resp_s2_eval.text) + metrics.get('comm_bf_bytes', 0)
-    return metrics, None
+    return finish_query(transaction_id, membership_filter, final_oprf_value, metrics, start_time)
+
+def is_stale_epoch_error(error):
+    # 409 from Server1 (qu built for an older row layout) or Server2 (ans and hint from different epochs).
+    return isinstance(error, requests.exceptions.HTTPError) and error.response is not None and \
+        error.response.status_code == 409
+
+def fetch_items_range(url, first_byte, last_byte):
+    resp = SESSION.get(url, headers={'Range': f"bytes={first_byte}-{last_byte}"}, timeout=300)
+    resp.raise_for_status()
+    return resp.content
+
+def fetch_queryable_items():
+    # Hex strings of QUERY_SAMPLE_SIZE items, or of every item when Server1 has no more than that. Only the
+    # header and the sampled records are transferred, so the cost does not grow with the database.
+    sample_size, windows = QUERY_SAMPLE_SIZE, QUERY_SAMPLE_WINDOWS
+    url = f"{S1_URL}/download/query_items"
+    (num_items, entry_len), offset = shared_logic.read_hash_file_header(
+        fetch_items_range(url, 0, ITEMS_HEADER_PROBE - 1))
+    if sample_size is None or sample_size >= num_items:
+        spans = [(0, num_items)] if num_items else []
+    else:
+        # Windows are aligned to their own size, so they never overlap.
+        window = max(1, sample_size // windows)
+        slots = sorted(random.sample(range(num_items // window), min(windows, num_items // window)))
+        spans = [(slot * window, (slot + 1) * window) for slot in slots]
+    records = b''.join(fetch_items_range(url, offset + start * entry_len, offset + stop * entry_len - 1)
+                       for start, stop in spans)
+    return list(dict.fromkeys(records[i:i + entry_len].hex() for i in range(0, len(records), entry_len)))
+
+def refresh_db_state(items=False):
+    # Picks up Server1's current layout after /update appended rows or rebuilt the database: db_params, the
+    # seed (new after a rebuild) and the OT table. The queryable item list is large, so it is only re-fetched
+    # when asked for.
+    global DB_PARAMS, LWE_SEED, QUERYABLE_HASHES
+    resp_params = SESSION.get(f"{S1_URL}/db-params")
+    resp_params.raise_for_status()
+    DB_PARAMS = {**resp_params.json()['db_params'], 'num_entries': DB_PARAMS.get('num_entries')}
+    resp_seed = SESSION.get(f"{S1_URL}/lwe-seed")
+    resp_seed.raise_for_status()
+    LWE_SEED = resp_seed.content
+    QUERY_POOL.reset(LWE_SEED, DB_PARAMS['num_rows'])
+    fetch_ot_table()
+    if items: QUERYABLE_HASHES = fetch_queryable_items()
+
+async def run_single_query_async(target_hash=None, retry_stale=True):
+    # s -> Server2 and qu -> Server1 go out together; the verification request (held by Server2 until
+    # s and ans are in) and the OPRF round trip run alongside them on the pooled session.
+    if target_hash is None: target_hash = bytes.fromhex(random.choice(QUERYABLE_HASHES))
+    start_time = time.time()
+    loop = asyncio.get_running_loop()
+    prepared, error_msg = await loop.run_in_executor(EXECUTOR, prepare_query, target_hash)
+    if prepared is None and retry_stale and error_msg == OT_MISS_ERROR:
+        await loop.run_in_executor(EXECUTOR, refresh_db_state)
+        return await run_single_query_async(target_hash, retry_stale=False)
+    if prepared is None: return None, error_msg
+    transaction_id, s, qu, metrics = prepared
+    send_tasks = [loop.run_in_executor(EXECUTOR, send_s, transaction_id, s, metrics),
+                  loop.run_in_executor(EXECUTOR, send_qu, transaction_id, qu, metrics)]
+    verify_tasks = [loop.run_in_executor(EXECUTOR, fetch_verification, transaction_id, metrics),
+                    loop.run_in_executor(EXECUTOR, oprf_query, transaction_id, target_hash, metrics)]
+    send_results = await asyncio.gather(*send_tasks, return_exceptions=True)
+    verify_results = await asyncio.gather(*verify_tasks, return_exceptions=True)
+    if retry_stale and any(is_stale_epoch_error(result) for result in send_results + verify_results):
+        await loop.run_in_executor(EXECUTOR, refresh_db_state)
+        return await run_single_query_async(target_hash, retry_stale=False)
+    for result in send_results:
+        if isinstance(result, Exception): return None, f"Failed to connect during computation: {result}"
+    for result in verify_results:
+        if isinstance(result, Exception): return None, f"S2 verification failed: {result}"
+    membership_filter, final_oprf_value = verify_results
+    return finish_query(transaction_id, membership_filter, final_oprf_value, metrics, start_time)
+
+def run_single_query():
+    return asyncio.run(run_single_query_async())
+
+def run_query_batch(k):
+    # k independent queries whose qu vectors go to Server1 as one (k, num_rows) stack.
+    start_time = time.time()
+    targets = [bytes.fromhex(h) for h in random.choices(QUERYABLE_HASHES, k=k)]
+    prepared_list = []
+    for target_hash in targets:
+        prepared, error_msg = prepare_query(target_hash)
+        if prepared is None: return None, error_msg
+        prepared_list.append(prepared)
+    transaction_ids = [p[0] for p in prepared_list]
+    try:
+        for transaction_id, s, _, metrics in prepared_list:
+            send_s(transaction_id, s, metrics)
+        qu_matrix = np.stack([p[2] for p in prepared_list])
+        response_s1, comm_qu_bytes = post_vector(f"{S1_URL}/compute-answer-batch", qu_matrix,
+                                                 {'transaction_ids': transaction_ids, 'epoch': DB_PARAMS.get('epoch')})
+        result_s1 = response_s1.json()
+    except requests.exceptions.RequestException as e:
+        return None, f"Failed to connect during computation: {e}"
+    metrics_list = []
+    for target_hash, (transaction_id, _, _, metrics) in zip(targets, prepared_list):
+        metrics.update({'batch_size': k, 'time_s1_computation': result_s1['core_computation_time'] / k,
+                        'comm_qu_bytes': comm_qu_bytes / k, 'comm_ans_bytes': result_s1.get('ans_bytes', 0) / k})
+        metrics, error_msg = verify_query(transaction_id, target_hash, metrics, start_time)
+        if metrics is None: return None, error_msg
+        metrics_list.append(metrics)
+    return metrics_list, None
+
+def setup_database(size, hash_len=HASH_LEN_BYTES):
+    # Preprocesses `size` entries on Server1, fetches the client's offline state and sets up Server2.
+    # Returns the offline metrics; raises requests.exceptions.RequestException when any step fails.
+    global DB_PARAMS, QUERYABLE_HASHES, LWE_SEED
+    print(f"向Server1发送预处理请求")
+    resp_s1_prep = requests.post(f"{S1_URL}/preprocess", json={'num_entries': size, 'hash_len': hash_len},
+                                 timeout=None)
+    resp_s1_prep.raise_for_status()
+    DB_PARAMS = resp_s1_prep.json()['db_params']
+    DB_PARAMS['num_entries'] = size
+    s1_preprocess_time = resp_s1_prep.json()['time']
+    print(f"S1预处理完成")
+
+    print("客户端正在下载可查询项列表...")
+    QUERYABLE_HASHES = fetch_queryable_items()
+    print(f"客户端下载可查询项列表完成, ")
+
+    print("客户端正在下载 A 矩阵种子...")
+    start_time = time.time()
+    resp_seed = requests.get(f"{S1_URL}/lwe-seed", timeout=600)
+    resp_seed.raise_for_status()
+    LWE_SEED = resp_seed.content
+    QUERY_POOL.reset(LWE_SEED, DB_PARAMS['num_rows'])
+    time_client_setup = time.time() - start_time
+    print(f"客户端下载 A 矩阵种子完成")
+
+    print("客户端正在下载 OT 查找表...")
+    comm_ot_setup_bytes = fetch_ot_table()
+    print(f"客户端下载 OT 查找表完成")
+
+    print("正在触发Server2进行设置...")
+    resp_s2_setup = requests.post(f"{S2_URL}/setup", json={})
+    resp_s2_setup.raise_for_status()
+    print(f"Server2设置完成")
+    return {
+        's1_preprocess_time': s1_preprocess_time,
+        'offline_client_setup_time': time_client_setup,
+        'offline_s2_setup_time': resp_s2_setup.json()['time'],
+        'offline_comm_client_bytes': len(resp_seed.content),
+        'offline_comm_ot_bytes': comm_ot_setup_bytes,
+        'offline_comm_s2_bytes': resp_s2_setup.json()['size_bytes'],
+    }
 
 def run_experiment():
-    global DB_PARAMS, QUERYABLE_HASHES
     results = []
 
     for size in DATABASE_SIZES:
@@ -115,40 +366,7 @@ def run_experiment():
         print(f"开始为规模 {size} 进行全自动设置...")
 
         try:
-           
-            print(f"向Server1发送预处理请求")
-            resp_s1_prep = requests.post(f"{S1_URL}/preprocess", json={'num_entries': size}, timeout=None)
-         
-
-            resp_s1_prep.raise_for_status()
-            DB_PARAMS = resp_s1_prep.json()['db_params']
-            DB_PARAMS['num_entries'] = size
-            s1_preprocess_time = resp_s1_prep.json()['time']
-            print(f"S1预处理完成") 
-
-        
-            print("客户端正在下载可查询项列表...")
-            resp_items = requests.get(f"{S1_URL}/download/query_items", timeout=300)
-            resp_items.raise_for_status()
-            QUERYABLE_HASHES = resp_items.json()
-            print(f"客户端下载可查询项列表完成, ")
-
-            print("客户端正在下载 A 矩阵...")
-            start_time = time.time()
-            with requests.get(f"{S1_URL}/download/A", stream=True, timeout=600) as r: 
-                r.raise_for_status()
-                open(A_FILE, 'wb').write(r.content)
-            time_client_setup = time.time() - start_time
-            comm_client_setup_bytes = os.path.getsize(A_FILE)
-            print(f"客户端下载 A 矩阵完成")
-
-            print("正在触发Server2进行设置...")
-            resp_s2_setup = requests.post(f"{S2_URL}/setup", json={})
-            resp_s2_setup.raise_for_status()
-            time_s2_setup = resp_s2_setup.json()['time']
-            comm_s2_setup_bytes = resp_s2_setup.json()['size_bytes']
-            print(f"Server2设置完成")
-
+            offline_metrics = setup_database(size)
         except requests.exceptions.RequestException as e:
             print(f"预处理或设置失败: {e}")
             continue
@@ -162,21 +380,13 @@ def run_experiment():
             else:
                 print(f"查询失败")
                 break
-            time.sleep(1)
 
         if not query_metrics_list:
             continue
 
         avg_metrics = pd.DataFrame(query_metrics_list).mean().to_dict()
-        avg_metrics.update({
-            'db_size': size,
-            'entry_len': HASH_LEN_BYTES,
-            's1_preprocess_time': s1_preprocess_time,
-            'offline_client_setup_time': time_client_setup,
-            'offline_s2_setup_time': time_s2_setup,
-            'offline_comm_client_bytes': comm_client_setup_bytes,
-            'offline_comm_s2_bytes': comm_s2_setup_bytes
-        })
+        avg_metrics.update({'db_size': size, 'entry_len': HASH_LEN_BYTES})
+        avg_metrics.update(offline_metrics)
         results.append(avg_metrics)
 
     if results:
@@ -185,6 +395,151 @@ def run_experiment():
         print("\n\n实验完成！")
         print(df)
 
+def start_local_servers(clients=0):
+    # Serves Server1 and Server2 from this process on loopback ephemeral ports and points all three parties
+    # at each other, so a benchmark can run on one machine. Server2 gets enough threads for `clients`
+    # concurrent queries. Returns the waitress servers.
+    global S1_URL, S2_URL
+    from waitress import create_server
+    import server1
+    import server2
+    server2.configure_server_threads(max(server2.SERVER_THREADS, S2_REQUESTS_PER_CLIENT * clients))
+    s1 = create_server(server1.app, host='127.0.0.1', port=0)
+    s2 = create_server(server2.app, host='127.0.0.1', port=0, threads=server2.SERVER_THREADS)
+    server1.S2_IP, server1.S2_PORT = '127.0.0.1', s2.effective_port
+    server2.S1_IP, server2.S1_PORT = '127.0.0.1', s1.effective_port
+    S1_URL, S2_URL = f"http://127.0.0.1:{s1.effective_port}", f"http://127.0.0.1:{s2.effective_port}"
+    server1.load_current_snapshot()
+    for server in (s1, s2):
+        threading.Thread(target=server.run, daemon=True).start()
+    return [s1, s2]
+
+async def drive_clients(clients, duration=None, num_queries=None):
+    # `clients` virtual clients issue queries back to back until `duration` seconds have passed or
+    # `num_queries` have been started in total, whichever comes first.
+    deadline = time.time() + duration if duration else float('inf')
+    budget = {'remaining': num_queries if num_queries else float('inf')}
+    samples, errors = [], []
+
+    async def virtual_client():
+        while time.time() < deadline and budget['remaining'] > 0:
+            budget['remaining'] -= 1
+            try:
+                metrics, error_msg = await run_single_query_async()
+            except Exception as e:
+                metrics, error_msg = None, str(e)
+            if metrics and metrics['verified']: samples.append(metrics)
+            else: errors.append(error_msg or "verification failed")
+
+    start_time = time.time()
+    await asyncio.gather(*(virtual_client() for _ in range(clients)))
+    return samples, errors, time.time() - start_time
+
+def percentile_summary(values):
+    values = np.asarray(values, dtype=np.float64)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'count': len(values), 'mean': float(values.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+def summarize_samples(samples, prefix):
+    names = sorted({k for m in samples for k in m if k.startswith(prefix)})
+    return {k[len(prefix):]: percentile_summary([m[k] for m in samples if k in m]) for k in names}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+def write_benchmark_results(runs, out_prefix):
+    # JSON keeps every run in full; the CSV flattens the same numbers to one row per (run, kind, name).
+    commit = git_commit()
+    with open(f"{out_prefix}.json", 'w') as f:
+        json.dump({'schema_version': BENCH_SCHEMA_VERSION, 'git_commit': commit, 'created': time.time(),
+                   'runs': runs}, f, indent=1)
+    with open(f"{out_prefix}.csv", 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=BENCH_CSV_FIELDS)
+        writer.writeheader()
+        for run in runs:
+            base = {'schema_version': BENCH_SCHEMA_VERSION, 'git_commit': commit, 'db_size': run['db_size'],
+                    'hash_len': run['hash_len'], 'clients': run['clients']}
+            writer.writerow({**base, 'kind': 'throughput_qps', 'name': 'online', 'count': run['completed'],
+                             'mean': run['throughput_qps']})
+            writer.writerow({**base, 'kind': 'errors', 'name': 'online', 'count': run['errors']})
+            for name, value in run['offline'].items():
+                writer.writerow({**base, 'kind': 'offline', 'name': name, 'count': 1, 'mean': value})
+            for kind in ('latency_s', 'bytes'):
+                for name, summary in run[kind].items():
+                    writer.writerow({**base, 'kind': kind, 'name': name, **summary})
+
+def check_server2_capacity(clients):
+    # Past Server2's thread count, queries queue for a thread and the benchmark measures that wait instead of
+    # throughput, so say so up front. Returns False when Server2 is too small for `clients`.
+    resp = SESSION.get(f"{S2_URL}/transaction-stats")
+    resp.raise_for_status()
+    threads = resp.json().get('server_threads')
+    if threads is None or S2_REQUESTS_PER_CLIENT * clients <= threads: return True
+    print(f"警告: {clients} 个并发客户端最多同时向Server2发出 {S2_REQUESTS_PER_CLIENT * clients} 个请求, "
+          f"但Server2只有 {threads} 个线程; 吞吐量和延迟将主要反映线程排队 (可减少 --clients 或用 --local)")
+    return False
+
+def run_benchmark(sizes, hash_lens, clients, duration=None, num_queries=None, warmup=0,
+                  out_prefix='benchmark_results'):
+    global VERBOSE
+    VERBOSE = False
+    # Each in-flight query keeps up to two requests open, plus one thread for generating the next query.
+    configure_http_pool(max(HTTP_POOL_SIZE, 3 * clients))
+    server2_capacity_ok = check_server2_capacity(clients)
+    runs = []
+    for size in sizes:
+        for hash_len in hash_lens:
+            print("=" * 50)
+            print(f"基准测试: 规模 {size}, 哈希长度 {hash_len}, 并发客户端 {clients}")
+            try:
+                offline_metrics = setup_database(size, hash_len)
+            except requests.exceptions.RequestException as e:
+                print(f"预处理或设置失败: {e}")
+                continue
+            if warmup: asyncio.run(drive_clients(clients, num_queries=warmup))
+            samples, errors, elapsed = asyncio.run(drive_clients(clients, duration, num_queries))
+            if errors: print(f"{len(errors)} 次查询失败, 例如: {errors[0]}")
+            run = {'db_size': size, 'hash_len': hash_len, 'clients': clients, 'duration': duration,
+                   'server2_capacity_ok': server2_capacity_ok,
+                   'num_queries': num_queries, 'warmup': warmup, 'completed': len(samples), 'errors': len(errors),
+                   'elapsed': elapsed, 'throughput_qps': len(samples) / elapsed, 'offline': offline_metrics,
+                   'latency_s': summarize_samples(samples, 'time_') if samples else {},
+                   'bytes': summarize_samples(samples, 'comm_') if samples else {}}
+            runs.append(run)
+            total = run['latency_s'].get('online_total', {})
+            print(f"完成 {len(samples)} 次查询, {run['throughput_qps']:.2f} 查询/秒, "
+                  f"p50={total.get('p50', 0) * 1000:.1f}ms p95={total.get('p95', 0) * 1000:.1f}ms "
+                  f"p99={total.get('p99', 0) * 1000:.1f}ms")
+    if runs:
+        write_benchmark_results(runs, out_prefix)
+        print(f"\n基准测试结果已写入 {out_prefix}.csv 和 {out_prefix}.json")
+    return runs
+
 
 if __name__ == '__main__':
-    run_experiment()
+    parser = argparse.ArgumentParser(description="PIR client")
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('experiment', help="three serial queries per DATABASE_SIZES entry (the default)")
+    p = sub.add_parser('bench', help="concurrent virtual clients; writes CSV and JSON results")
+    p.add_argument('--clients', type=int, default=8)
+    p.add_argument('--duration', type=float, default=None, help="seconds to run each configuration")
+    p.add_argument('--queries', type=int, default=None, help="total queries per configuration")
+    p.add_argument('--warmup', type=int, default=10, help="queries run and discarded before measuring")
+    p.add_argument('--sizes', type=int, nargs='+', default=DATABASE_SIZES)
+    p.add_argument('--hash-lens', type=int, nargs='+', default=[HASH_LEN_BYTES])
+    p.add_argument('--out', default='benchmark_results', help="output path prefix for .csv and .json")
+    p.add_argument('--local', action='store_true', help="run both servers in this process on loopback")
+    p.add_argument('--precompute', type=int, default=PRECOMPUTE_POOL_SIZE,
+                   help="query material kept ready in the background (0 generates each query inline)")
+    args = parser.parse_args()
+    if args.command == 'bench':
+        if args.duration is None and args.queries is None: parser.error("bench needs --duration or --queries")
+        if args.local: start_local_servers(args.clients)
+        QUERY_POOL.capacity = args.precompute
+        run_benchmark(args.sizes, args.hash_lens, args.clients, args.duration, args.queries, args.warmup, args.out)
+    else:
+        run_experiment()
@@ -0,0 +1,66 @@
+# db_tool.py (Writes and inspects the database_<n>.npy input files Server1's /preprocess picks up)
+import argparse
+import json
+import os
+
+import numpy as np
+
+import shared_logic
+
+# Hex strings converted per step when turning a JSON list into an item file.
+CONVERT_CHUNK_ITEMS = 1 << 20
+
+
+def generate(args):
+    out = args.out or f"database_{args.num_entries}.npy"
+    shared_logic.save_hash_file(out, shared_logic.generate_hash_database(args.num_entries, args.hash_len))
+    print(f"wrote {args.num_entries} hashes of {args.hash_len} bytes to {out}")
+
+
+def convert(args):
+    # The JSON list is parsed once; the records are written chunk by chunk straight into the output file.
+    out = args.out or os.path.splitext(args.json_file)[0] + '.npy'
+    with open(args.json_file) as f: hex_items = json.load(f)
+    if not hex_items: raise SystemExit(f"{args.json_file} holds no hashes")
+    entry_len = len(hex_items[0]) // 2
+    tmp_path = out + '.tmp'
+    items = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(hex_items), entry_len))
+    for start in range(0, len(hex_items), CONVERT_CHUNK_ITEMS):
+        chunk = hex_items[start:start + CONVERT_CHUNK_ITEMS]
+        if any(len(h) != 2 * entry_len for h in chunk): raise SystemExit(f"every hash must be {entry_len} bytes")
+        items[start:start + len(chunk)] = np.frombuffer(bytes.fromhex(''.join(chunk)), dtype=np.uint8).reshape(
+            len(chunk), entry_len)
+    items.flush()
+    del items
+    os.replace(tmp_path, out)
+    print(f"wrote {len(hex_items)} hashes of {entry_len} bytes to {out}")
+
+
+def info(args):
+    items = shared_logic.load_hash_file(args.file)
+    num_items, entry_len = items.shape
+    duplicates = num_items - len(shared_logic.distinct_rows(items)) if args.check else None
+    print(f"{args.file}: {num_items} hashes of {entry_len} bytes, {os.path.getsize(args.file)} bytes on disk"
+          + (f", {duplicates} duplicates" if duplicates is not None else ""))
+    for row in items[:args.head]: print(row.tobytes().hex())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="PIR database input files")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('generate', help="write num_entries distinct random hashes")
+    p.add_argument('num_entries', type=int)
+    p.add_argument('--hash-len', type=int, default=32)
+    p.add_argument('--out', help="defaults to database_<num_entries>.npy")
+    p.set_defaults(func=generate)
+    p = sub.add_parser('convert', help="turn a legacy JSON list of hex hashes into an item file")
+    p.add_argument('json_file')
+    p.add_argument('--out', help="defaults to the JSON file's name with .npy")
+    p.set_defaults(func=convert)
+    p = sub.add_parser('info', help="shape and first hashes of an item file")
+    p.add_argument('file')
+    p.add_argument('--head', type=int, default=3)
+    p.add_argument('--check', action='store_true', help="also count duplicate hashes")
+    p.set_defaults(func=info)
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,79 @@
+# query_pool.py (Client-side precomputation of the target-independent part of a query)
+import threading
+from collections import deque
+
+import numpy as np
+
+import shared_logic
+
+
+def make_query_material(seed, num_rows):
+    # A fresh secret s and its masked vector sA + e mod Q; a query for row b only adds Δ at index b.
+    s = np.random.randint(0, shared_logic.LWE_Q, size=shared_logic.LWE_N, dtype=np.uint32)
+    e = shared_logic.generate_noise_vector(num_rows)
+    sA = shared_logic.seeded_vec_times_A(seed, s, num_rows).astype(np.int64)
+    return s, ((sA + e) % shared_logic.LWE_Q).astype(np.uint32)
+
+def mask_to_query(masked, target_row):
+    # Turns a pool entry into qu in place; each entry is used for exactly one query.
+    masked[target_row] = (int(masked[target_row]) + shared_logic.SCALING_FACTOR) % shared_logic.LWE_Q
+    return masked
+
+
+# Up to `capacity` (s, sA + e) pairs made ahead of time by one background thread, for the LWE seed and row
+# count of the database currently queried. Material is only valid for the (seed, num_rows) it was made for,
+# so switching to another layout drops what is queued. take() falls back to computing inline when the pool
+# is empty, and every take() wakes the thread to refill the slot, so the pool keeps up under sustained load.
+# If making material fails, the thread logs it and idles until reset() switches to another layout.
+class QueryMaterialPool:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._cond = threading.Condition()
+        self._items = deque()
+        self._key = None
+        self._thread = None
+        self._failed_key = None
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def reset(self, seed, num_rows):
+        with self._cond:
+            if self._key == (seed, num_rows): return
+            self._key = (seed, num_rows)
+            self._items.clear()
+            if self.capacity and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._fill, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def take(self, seed, num_rows):
+        self.reset(seed, num_rows)
+        with self._cond:
+            if self._items:
+                self.hits += 1
+                self._cond.notify_all()
+                return self._items.popleft()
+            self.misses += 1
+        return make_query_material(seed, num_rows)
+
+    def _fill(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._items) < self.capacity and self._key != self._failed_key)
+                key = self._key
+            try:
+                material = make_query_material(*key)
+            except Exception as e:
+                print(f"query pool: precomputation for {key[1]} rows failed, computing queries inline - {e!r}")
+                with self._cond:
+                    self._failed_key = key
+                    self.failures += 1
+                continue
+            with self._cond:
+                if self._key == key and len(self._items) < self.capacity: self._items.append(material)
+
+    def stats(self):
+        with self._cond:
+            return {'ready': len(self._items), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses,
+                    'failures': self.failures}
@@ -3,10 +3,22 @@ import numpy as np
 import time
 import os
 import requests
-from flask import Flask, request, jsonify, send_file
-from collections import defaultdict
+from flask import Flask, request, jsonify, make_response, Response
 import traceback
 import json
+import threading
+import hashlib
+import shutil
+import sys
+import atexit
+import argparse
+import subprocess
+import signal
+import math
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
 
 import shared_logic
 
@@ -14,155 +26,1057 @@ import shared_logic
 S2_IP = ""
 S2_PORT = 
 SERVER1_PORT = 
-A_FILE = "lwe_matrix_A.npy"
 HINT_FILE = "hint_matrix.npy"
-QUERYABLE_ITEMS_FILE = "queryable_hashes.json"
+QUERYABLE_ITEMS_FILE = "queryable_items.npy"
+DB_MATRIX_FILE = "db_matrix.npy"
+PREFIX_FILE = "prefixes.npy"
+ENCRYPTED_INDEX_FILE = "encrypted_index.npy"
+OT_TABLE_FILE = "ot_table.bin"
+MANIFEST_FILE = "manifest.json"
+ROW_COUNTS_FILE = "row_counts.npy"
+# Log of the batches applied by /update since the snapshot was built, replayed over QUERYABLE_ITEMS_FILE.
+UPDATES_FILE = "updates.json"
+# After an update, /download/query_items serves the replayed item list, written once per epoch to this file.
+EPOCH_ITEMS_FILE = "queryable_items.e{epoch}.npy"
+# Preprocessed state lives in SNAPSHOT_ROOT/db_<num_entries>/; CURRENT names the one served after a restart.
+SNAPSHOT_ROOT = "snapshots"
+# Highest epoch ever served, beside CURRENT. Clients cache the OT table and Server2 patches its hint by epoch
+# alone, so an activated snapshot whose epochs are not above it is moved past it first.
+EPOCH_HIGH_WATER_FILE = "EPOCH"
+SNAPSHOT_VERSION = 5
+# Rows are built with room to grow by this fraction of the fullest row (at least one slot), so additions
+# rarely find their row full; those that do are added by a background compaction.
+ROW_SLACK_FRACTION = 0.125
+# Re-hash every snapshot file when loading on startup; sizes are always checked.
+SNAPSHOT_VERIFY_ON_START = False
+# Bit width used when forwarding ans to Server2; None sends raw uint32 words.
+ANS_WIRE_BITS = shared_logic.LWE_Q_BITS
+# Column-range workers for the answer and hint products; both can be changed at runtime through /config.
+WORKER_COUNT = os.cpu_count() or 1
+CHUNK_SIZE = 256
+# Read size when streaming the hint to Server2.
+HINT_CHUNK_SIZE = 1 << 20
+# Sharding: a coordinator (SHARD_URLS set) splits qu by row range across shard processes serving
+# /partial-answer; a shard (SHARD_INDEX/SHARD_COUNT set) scans only its own rows of the shared snapshot.
+SHARD_TIMEOUT = 60
+# Answers reach Server2 through a bounded queue drained by background senders over one keep-alive session.
+# A full queue holds /compute-answer for up to FORWARD_ENQUEUE_TIMEOUT seconds before it answers 503.
+FORWARD_QUEUE_SIZE = 1024
+FORWARD_ENQUEUE_TIMEOUT = 10
+FORWARD_WORKERS = 2
+# Queued answers coalesced into one /receive-ans-batch delivery, at most this many rows.
+FORWARD_BATCH_MAX = 64
+FORWARD_TIMEOUT = 10
+FORWARD_ATTEMPTS = 4
+FORWARD_BACKOFF = 0.05
+FORWARD_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+# Sparse hint deltas kept in memory for Server2 to catch up with; older epochs need a full hint download.
+HINT_DELTA_HISTORY = 64
 
 app = Flask(__name__)
+app.config.update({'WORKER_COUNT': WORKER_COUNT, 'CHUNK_SIZE': CHUNK_SIZE,
+                   'WORKER_POOL': ThreadPoolExecutor(max_workers=WORKER_COUNT),
+                   'SHARD_INDEX': None, 'SHARD_COUNT': None, 'SHARD_URLS': [], 'SHARD_POOL': None})
+SHARD_SESSION = requests.Session()
+# Held while a product submits its column blocks and while /config swaps WORKER_POOL, so a pool is only shut
+# down once nothing can submit to it any more; blocks already queued on it still run.
+WORKER_POOL_LOCK = threading.Lock()
+METRICS = shared_logic.MetricsRegistry('pir_s1')
+METRICS.register_gauges(lambda: {'epoch': app.config.get('EPOCH', 0),
+                                 'layout_epoch': app.config.get('LAYOUT_EPOCH', 0)})
+shared_logic.instrument_app(app, METRICS)
+# Per-worker float64 scratch for the current column block, reused across chunks and requests.
+_scratch = threading.local()
 
 
-def partition_db_by_prefix(db_hashes):
-   
-    local_db_params = {}
-    groups = defaultdict(list)
-    for h in db_hashes:
-        prefix = shared_logic.get_prefix_from_hash(h)
-        groups[prefix].append(h)
-    prefix_list = sorted(groups.keys())
-    num_rows = len(prefix_list)
-    max_cols_per_row = max(len(items) for items in groups.values()) if groups else 0
-    entry_vec_len = len(db_hashes[0]) if db_hashes else 0
-    num_cols = max_cols_per_row * entry_vec_len
-    local_db_params.update({'num_rows': num_rows, 'num_cols': num_cols, 'max_cols_per_row': max_cols_per_row,
-                            'entry_vec_len': entry_vec_len})
-    db_matrix = np.zeros((num_rows, num_cols), dtype=np.uint8)
-    for i, prefix in enumerate(prefix_list):
-        row_items = groups[prefix]
-        row_vec = np.array([], dtype=np.uint8);
-        for item_bytes in row_items:
-            row_vec = np.concatenate([row_vec, shared_logic.bytes_to_int_array(item_bytes)])
-        padding_len = num_cols - len(row_vec)
-        if padding_len > 0:
-            random_padding = np.random.randint(0, shared_logic.LWE_P, size=padding_len, dtype=np.uint8)
-            padded_row_vec = np.concatenate([row_vec, random_padding])
+class UpdateGate:
+    # Answers hold the gate shared while they read DB_MATRIX; /update and /preprocess hold it exclusively
+    # while they change the database, so no answer mixes two epochs. Waiting writers block new readers.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._writing)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._writing)
+            self._writing = True
+            self._cond.wait_for(lambda: self._readers == 0)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+UPDATE_GATE = UpdateGate()
+# Serialises the writers of the database: /update, /preprocess and the swap at the end of a compaction.
+# Answers only take UPDATE_GATE, which writers hold just while they change the active snapshot.
+WRITER_LOCK = threading.Lock()
+# While a background compaction runs, /update batches are queued here and applied once it has swapped in.
+# A failed rebuild keeps its batches and is retried; last_error says why until one succeeds.
+COMPACTION = {'thread': None, 'queued': [], 'failures': 0, 'last_error': None}
+COMPACTION_RETRY_DELAY = 5
+METRICS.register_gauges(lambda: {'compaction_failures': COMPACTION['failures']})
+# Serialises writing EPOCH_ITEMS_FILE when several clients ask for the items of a new epoch at once.
+ITEMS_FILE_LOCK = threading.Lock()
+
+
+class AnswerForwarder:
+    # Takes computed answers off the request thread. Each sender blocks for one queued entry, then drains
+    # whatever else is waiting (up to FORWARD_BATCH_MAX rows) and delivers it grouped by epoch and width: a
+    # single row to /receive-ans, several to /receive-ans-batch. Both are idempotent, so failed deliveries are
+    # retried with exponential backoff; after FORWARD_ATTEMPTS the transactions are aborted on Server2.
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=FORWARD_QUEUE_SIZE)
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=FORWARD_WORKERS))
+        self._lock = threading.Lock()
+        self._senders = []
+
+    def submit(self, ans_matrix, transaction_ids, epoch):
+        # Raises queue.Full when the senders have fallen FORWARD_QUEUE_SIZE entries behind.
+        with self._lock:
+            if not self._senders:
+                self._senders = [threading.Thread(target=self._run, daemon=True) for _ in range(FORWARD_WORKERS)]
+                for sender in self._senders: sender.start()
+        self.queue.put((ans_matrix, transaction_ids, epoch, time.perf_counter()), timeout=FORWARD_ENQUEUE_TIMEOUT)
+
+    def _run(self):
+        while True:
+            pending = [self.queue.get()]
+            rows = len(pending[0][1])
+            while rows < FORWARD_BATCH_MAX:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+                rows += len(pending[-1][1])
+            groups = {}
+            for entry in pending: groups.setdefault((entry[2], entry[0].shape[1]), []).append(entry)
+            for (epoch, _), entries in groups.items():
+                try:
+                    self._deliver(entries, epoch)
+                except Exception:
+                    print(f"S1 CRASHED: {traceback.format_exc()}")
+
+    def _deliver(self, entries, epoch):
+        transaction_ids = [tid for entry in entries for tid in entry[1]]
+        if len(transaction_ids) == 1:
+            path, ans, meta = '/receive-ans', entries[0][0][0], {'transaction_id': transaction_ids[0], 'epoch': epoch}
         else:
-            padded_row_vec = row_vec
-        db_matrix[i, :] = padded_row_vec
-    return db_matrix, [p.hex() for p in prefix_list], local_db_params
+            path, meta = '/receive-ans-batch', {'transaction_ids': transaction_ids, 'epoch': epoch}
+            ans = np.concatenate([entry[0] for entry in entries])
+        with METRICS.stage('serialize'):
+            body = shared_logic.encode_array(ans, meta, bits=ANS_WIRE_BITS)
+        error = None
+        for attempt in range(FORWARD_ATTEMPTS):
+            if attempt: time.sleep(FORWARD_BACKOFF * 2 ** (attempt - 1))
+            try:
+                with METRICS.stage('forward'):
+                    self.session.post(f"http://{S2_IP}:{S2_PORT}{path}", data=body, timeout=FORWARD_TIMEOUT,
+                                      headers={'Content-Type': shared_logic.WIRE_CONTENT_TYPE}).raise_for_status()
+                error = None
+                break
+            except requests.exceptions.RequestException as e:
+                error = e
+                METRICS.inc('forward_errors_total')
+                # A 4xx will not go away on retry.
+                if isinstance(e, requests.exceptions.HTTPError) and e.response.status_code < 500: break
+        if error is not None:
+            METRICS.inc('forward_failures_total', len(transaction_ids))
+            print(f"S1: 转发ans到S2失败, 放弃 {len(transaction_ids)} 个事务: {error}")
+            for transaction_id in transaction_ids:
+                try:
+                    self.session.post(f"http://{S2_IP}:{S2_PORT}/abort-transaction/{transaction_id}", timeout=1)
+                except requests.exceptions.RequestException:
+                    pass
+            return
+        delivered = time.perf_counter()
+        for entry in entries: METRICS.observe('forward_delivery_seconds', delivered - entry[3])
+        METRICS.observe('forward_batch_rows', len(transaction_ids), FORWARD_BATCH_BUCKETS)
+        METRICS.inc('forwarded_answers_total', len(transaction_ids))
 
-@app.route('/preprocess', methods=['POST'])
-def preprocess():
-    try:
-        data = request.json
-        num_entries = data['num_entries']
-        print(f"S1: 开始预处理...规模: {num_entries}")
-        pregen_file_name = f"database_{num_entries}.json"
-        start_time = time.time()
-        if os.path.exists(pregen_file_name):
-            print(f"S1: 发现预生成的数据文件: {pregen_file_name}，正在加载...")
-            with open(pregen_file_name, 'r') as f:
-                db_hashes_hex = json.load(f)
-            db_hashes = [bytes.fromhex(h) for h in db_hashes_hex]
-            print("S1: 数据文件加载完成。")
+FORWARDER = AnswerForwarder()
+METRICS.register_gauges(lambda: {'forward_queue_depth': FORWARDER.queue.qsize()})
+
+
+def partition_db_by_prefix(db_hashes, prefix_bits=None, slack_fraction=0.0):
+    # db_hashes: list of equal-length bytes or an (N, HASH_LEN) uint8 array. Rows are prefix groups in
+    # ascending prefix order; items are scattered into a preallocated matrix in a few bulk operations.
+    # prefix_bits defaults to the width choose_prefix_bits picks for these hashes; slack_fraction widens
+    # every row past the fullest one, leaving free slots for later additions.
+    hash_array = shared_logic.hashes_to_array(db_hashes)
+    num_entries, entry_vec_len = hash_array.shape
+    if prefix_bits is None:
+        prefix_bits = shared_logic.choose_prefix_bits(shared_logic.leading_words(hash_array), entry_vec_len)
+    prefixes = shared_logic.prefix_values(hash_array, prefix_bits)
+    order = np.argsort(prefixes, kind='stable')
+    prefix_values, row_starts, row_counts = np.unique(prefixes[order], return_index=True, return_counts=True)
+    num_rows = len(prefix_values)
+    max_cols_per_row = int(row_counts.max()) if num_rows else 0
+    if slack_fraction and num_rows: max_cols_per_row += max(1, math.ceil(max_cols_per_row * slack_fraction))
+    num_cols = max_cols_per_row * entry_vec_len
+    local_db_params = {'num_rows': num_rows, 'num_cols': num_cols, 'max_cols_per_row': max_cols_per_row,
+                       'entry_vec_len': entry_vec_len, 'prefix_bits': prefix_bits,
+                       'padding_ratio': padding_ratio(num_entries, num_rows, max_cols_per_row)}
+    db_matrix = np.empty((num_rows, num_cols), dtype=np.uint8)
+    db_slots = db_matrix.reshape(num_rows, max_cols_per_row, entry_vec_len)
+    item_rows = np.repeat(np.arange(num_rows), row_counts)
+    item_slots = np.arange(num_entries) - np.repeat(row_starts, row_counts)
+    db_slots[item_rows, item_slots] = hash_array[order]
+    padding_mask = np.arange(max_cols_per_row) >= row_counts[:, None]
+    db_slots[padding_mask] = np.random.randint(0, shared_logic.LWE_P, size=(int(padding_mask.sum()), entry_vec_len),
+                                               dtype=np.uint8)
+    prefix_width = 2 * shared_logic.prefix_nbytes(prefix_bits)
+    prefix_list = [f"{p:0{prefix_width}x}" for p in prefix_values.tolist()]
+    return db_matrix, prefix_list, local_db_params
+
+def padding_ratio(num_entries, num_rows, max_cols_per_row):
+    # Share of the DB matrix's item slots that hold random padding rather than items.
+    num_slots = num_rows * max_cols_per_row
+    return 1 - num_entries / num_slots if num_slots else 0.0
+
+def snapshot_params():
+    return {'version': SNAPSHOT_VERSION, 'lwe_n': shared_logic.LWE_N, 'lwe_q': shared_logic.LWE_Q,
+            'lwe_p': shared_logic.LWE_P}
+
+def write_snapshot(snapshot_dir, files, manifest, staging_suffix=".tmp"):
+    # files: name -> ndarray (saved as .npy), bytes, or a JSON-serialisable object. Written to a staging
+    # directory beside snapshot_dir, which is returned; install_snapshot renames it into place, so a crash
+    # never leaves a half-written snapshot behind.
+    tmp_dir = snapshot_dir + staging_suffix
+    if os.path.exists(tmp_dir): shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, value in files.items():
+        path = os.path.join(tmp_dir, name)
+        if isinstance(value, np.ndarray): np.save(path, value)
+        elif isinstance(value, bytes):
+            with open(path, 'wb') as f: f.write(value)
         else:
-            print("S1: 未发现预生成的数据文件，将动态生成数据...")
-            db_hashes = shared_logic.generate_hash_database(num_entries, 32)  
+            with open(path, 'w') as f: json.dump(value, f)
+    manifest['files'] = {}
+    write_manifest(tmp_dir, manifest, files)
+    return tmp_dir
 
-        db_hashes_hex = [h.hex() for h in db_hashes]
-        with open(QUERYABLE_ITEMS_FILE, 'w') as f:
-            json.dump(db_hashes_hex, f)
+def install_snapshot(staging_dir, snapshot_dir):
+    if os.path.exists(snapshot_dir): shutil.rmtree(snapshot_dir)
+    os.replace(staging_dir, snapshot_dir)
+    with open(os.path.join(SNAPSHOT_ROOT, "CURRENT"), 'w') as f: f.write(os.path.basename(snapshot_dir))
 
-        db_matrix, prefix_list, db_params = partition_db_by_prefix(db_hashes)
+def write_manifest(snapshot_dir, manifest, changed_files=(), digests=None):
+    # Re-hashes changed_files into manifest['files'], takes the entries in digests as they are, and replaces
+    # the manifest atomically.
+    manifest['files'].update(digests or {})
+    for name in changed_files:
+        path = os.path.join(snapshot_dir, name)
+        manifest['files'][name] = {'sha256': shared_logic.file_sha256(path), 'size': os.path.getsize(path)}
+    manifest['checksum'] = hashlib.sha256(json.dumps(manifest['files'], sort_keys=True).encode()).hexdigest()
+    tmp_path = os.path.join(snapshot_dir, MANIFEST_FILE + '.tmp')
+    with open(tmp_path, 'w') as f: json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(snapshot_dir, MANIFEST_FILE))
 
-        app.config['DB_PARAMS'] = db_params
-        app.config['DB_MATRIX'] = db_matrix
+def load_snapshot(snapshot_dir, verify=True):
+    # Returns the manifest and memory-mapped arrays, or None when the snapshot is missing, stale or corrupt.
+    manifest_path = os.path.join(snapshot_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path): return None
+    with open(manifest_path) as f: manifest = json.load(f)
+    if manifest.get('params') != snapshot_params() or manifest.get('updating'): return None
+    for name, info in manifest['files'].items():
+        path = os.path.join(snapshot_dir, name)
+        if not os.path.exists(path) or os.path.getsize(path) != info['size']: return None
+        if verify and shared_logic.file_sha256(path) != info['sha256']: return None
+    with open(os.path.join(snapshot_dir, OT_TABLE_FILE), 'rb') as f: ot_table = f.read()
+    return {'dir': os.path.abspath(snapshot_dir), 'manifest': manifest, 'ot_table': ot_table,
+            'db_matrix': np.load(os.path.join(snapshot_dir, DB_MATRIX_FILE), mmap_mode='r'),
+            'prefixes': np.load(os.path.join(snapshot_dir, PREFIX_FILE), mmap_mode='r'),
+            'encrypted_index': np.load(os.path.join(snapshot_dir, ENCRYPTED_INDEX_FILE), mmap_mode='r'),
+            'row_counts': np.load(os.path.join(snapshot_dir, ROW_COUNTS_FILE))}
 
-        A = shared_logic.generate_lwe_matrix_A(shared_logic.LWE_N, db_params['num_rows'])
+def epoch_high_water():
+    path = os.path.join(SNAPSHOT_ROOT, EPOCH_HIGH_WATER_FILE)
+    stored = 0
+    if os.path.exists(path):
+        with open(path) as f: stored = int(f.read().strip() or 0)
+    return max(stored, app.config.get('EPOCH') or 0)
 
-        print("S1: 正在计算hint矩阵...")
-        chunk_size = 256
-        num_cols = db_matrix.shape[1]
-        hint = np.zeros((A.shape[0], num_cols), dtype=np.uint32)
-        A_i64 = A.astype(np.int64)
-        for i in range(0, num_cols, chunk_size):
-            end = min(i + chunk_size, num_cols)
-            hint_chunk = (A_i64 @ db_matrix[:, i:end].astype(np.int64)) % shared_logic.LWE_Q
-            hint[:, i:end] = hint_chunk
+def rebase_epochs(snapshot, floor):
+    # Shifts all of the snapshot's epochs, keeping their spacing, until the oldest is above floor, so none of
+    # them (the OT table's ETag is the layout epoch) can name something served before. The shift is recorded
+    # in its manifest so shards and a restart see the same numbers.
+    manifest = snapshot['manifest']
+    shift = floor + 1 - manifest['build_epoch']
+    for key in ('epoch', 'build_epoch', 'layout_epoch'): manifest[key] += shift
+    manifest['db_params'] = {**manifest['db_params'], 'epoch': manifest['epoch']}
+    write_manifest(snapshot['dir'], manifest)
 
-        np.save(A_FILE, A)
-        np.save(HINT_FILE, hint)
-        print("S1: 正在生成OT加密列表...")
-        encrypted_list = []
-        for i, prefix_hex in enumerate(prefix_list):
-            encrypted_list.append(
-                shared_logic.encrypt_index(shared_logic.get_key_from_prefix(bytes.fromhex(prefix_hex)), i))
+def activate_snapshot(snapshot):
+    manifest = snapshot['manifest']
+    # Only the coordinator numbers epochs; a shard serves the manifest the coordinator has already rebased.
+    if not app.config.get('SHARD_COUNT'):
+        floor = epoch_high_water()
+        # Anything but the snapshot already served at floor, e.g. an older one reused by /preprocess.
+        served_dir = app.config.get('SNAPSHOT_DIR')
+        if manifest['epoch'] < floor or (manifest['epoch'] == floor and served_dir not in (None, snapshot['dir'])):
+            rebase_epochs(snapshot, floor)
+        os.makedirs(SNAPSHOT_ROOT, exist_ok=True)
+        with open(os.path.join(SNAPSHOT_ROOT, EPOCH_HIGH_WATER_FILE), 'w') as f: f.write(str(manifest['epoch']))
+    prefix_width = 2 * shared_logic.prefix_nbytes(manifest['db_params']['prefix_bits'])
+    app.config.update({
+        'SNAPSHOT_DIR': snapshot['dir'], 'MANIFEST': manifest, 'EPOCH': manifest['epoch'],
+        'LAYOUT_EPOCH': manifest['layout_epoch'], 'DB_PARAMS': manifest['db_params'],
+        'LWE_SEED': bytes.fromhex(manifest['lwe_seed']),
+        'DB_MATRIX': snapshot['db_matrix'],
+        'PREFIX_LIST': [f"{p:0{prefix_width}x}" for p in snapshot['prefixes'].tolist()],
+        'ENCRYPTED_INDEX_LIST': [token.decode('utf-8') for token in snapshot['encrypted_index'].tolist()],
+        'OT_TABLE': snapshot['ot_table'],
+        'HINT_INFO': manifest['files'][HINT_FILE],
+        'ROW_COUNTS': snapshot['row_counts'],
+        'HINT_DELTAS': [],
+    })
 
-        app.config['ENCRYPTED_INDEX_LIST'] = encrypted_list
+def build_snapshot(snapshot_dir, num_entries, db_hashes, input_checksum, staging_suffix=".tmp"):
+    # Writes the snapshot for db_hashes to a staging directory and returns it, for install_snapshot.
+    db_matrix, prefix_list, db_params = partition_db_by_prefix(db_hashes, slack_fraction=ROW_SLACK_FRACTION)
 
-        end_time = time.time()
+    lwe_seed = shared_logic.generate_lwe_seed()
 
-        print(f"S1: 预处理完成。服务器计算耗时: {end_time - start_time:.4f} 秒")
-        return jsonify({"status": "preprocessing complete", "db_params": db_params, "time": end_time - start_time})
+    print("S1: 正在计算hint矩阵...")
+    with METRICS.stage('hint'):
+        hint = compute_hint(lwe_seed, db_matrix)
 
+    print("S1: 正在生成OT加密列表...")
+    encrypted_list = []
+    for i, prefix_hex in enumerate(prefix_list):
+        encrypted_list.append(
+            shared_logic.encrypt_index(shared_logic.get_key_from_prefix(bytes.fromhex(prefix_hex)), i))
+
+    epoch = epoch_high_water() + 1
+    db_params['epoch'] = epoch
+    prefixes = shared_logic.prefix_values(db_hashes, db_params['prefix_bits'])
+    row_counts = np.unique(prefixes, return_counts=True)[1]
+    print("S1: 正在写入预处理快照...")
+    return write_snapshot(snapshot_dir, {
+        DB_MATRIX_FILE: db_matrix, PREFIX_FILE: np.array([int(p, 16) for p in prefix_list], dtype=np.uint32),
+        HINT_FILE: hint,
+        ENCRYPTED_INDEX_FILE: np.array([token.encode('utf-8') for token in encrypted_list]),
+        OT_TABLE_FILE: shared_logic.build_ot_table(prefix_list, encrypted_list, epoch),
+        QUERYABLE_ITEMS_FILE: np.asarray(db_hashes),
+        ROW_COUNTS_FILE: row_counts.astype(np.int64), UPDATES_FILE: [],
+    }, {'params': snapshot_params(), 'num_entries': num_entries, 'input_checksum': input_checksum,
+        'epoch': epoch, 'build_epoch': epoch, 'layout_epoch': epoch, 'db_params': db_params,
+        'lwe_seed': lwe_seed.hex(), 'created': time.time()}, staging_suffix)
+
+@app.route('/preprocess', methods=['POST'])
+def preprocess():
+    try:
+        with WRITER_LOCK:
+            # A running compaction would swap its rebuild of the old database in over this one.
+            if COMPACTION['thread'] is not None: return jsonify({"error": "compaction in progress, retry later"}), 409
+            return preprocess_database(request.json)
     except Exception as e:
         print(f"S1 CRASHED: {traceback.format_exc()}")
         return jsonify({"error": "S1 internal server error", "details": str(e)}), 500
 
+def preprocess_database(data):
+    num_entries = data['num_entries']
+    hash_len = data.get('hash_len', 32)
+    print(f"S1: 开始预处理...规模: {num_entries}")
+    # database_<n>.npy (see db_tool.py) is memory-mapped; a legacy JSON hex list is still accepted.
+    pregen_file_name = next((name for name in (f"database_{num_entries}.npy", f"database_{num_entries}.json")
+                             if os.path.exists(name)), None)
+    snapshot_dir = os.path.join(SNAPSHOT_ROOT, f"db_{num_entries}")
+    start_time = time.time()
+    input_checksum = shared_logic.file_sha256(pregen_file_name) if pregen_file_name else None
+    snapshot = None if data.get('force') else load_snapshot(snapshot_dir, verify=True)
+    # Without an input file the data was generated, and the snapshot's own item list is the database
+    # as long as it was generated with the requested hash length.
+    if input_checksum is None:
+        reused = snapshot is not None and snapshot['manifest']['db_params']['entry_vec_len'] == hash_len
+    else:
+        reused = snapshot is not None and snapshot['manifest']['input_checksum'] == input_checksum
+    if reused:
+        print(f"S1: 输入数据未变化，复用预处理快照: {snapshot_dir}")
+    else:
+        if input_checksum is not None:
+            print(f"S1: 发现预生成的数据文件: {pregen_file_name}，正在加载...")
+            db_hashes = shared_logic.load_hash_file(pregen_file_name)
+            print("S1: 数据文件加载完成。")
+        else:
+            print("S1: 未发现预生成的数据文件，将动态生成数据...")
+            db_hashes = shared_logic.generate_hash_database(num_entries, hash_len)
+        os.makedirs(SNAPSHOT_ROOT, exist_ok=True)
+        staging_dir = build_snapshot(snapshot_dir, num_entries, db_hashes, input_checksum)
+    with UPDATE_GATE.exclusive():
+        if not reused:
+            install_snapshot(staging_dir, snapshot_dir)
+            snapshot = load_snapshot(snapshot_dir, verify=False)
+        activate_snapshot(snapshot)
+    notify_shards()
+    db_params = app.config['DB_PARAMS']
+
+    end_time = time.time()
+
+    print(f"S1: 预处理完成。服务器计算耗时: {end_time - start_time:.4f} 秒")
+    return jsonify({"status": "preprocessing complete", "db_params": db_params, "time": end_time - start_time,
+                    "snapshot_reused": reused})
+
 # ... (The rest of the file is unchanged) ...
 @app.route('/download/<filename>', methods=['GET'])
 def download_file(filename):
-    file_path = None
-    if filename == 'A':
-        file_path = A_FILE
-    elif filename == 'hint':
-        file_path = HINT_FILE
+    snapshot_dir = app.config.get('SNAPSHOT_DIR', os.path.abspath(SNAPSHOT_ROOT))
+    if filename == 'hint':
+        if 'HINT_INFO' not in app.config: return "File not ready", 408
+        return send_file_range(os.path.join(snapshot_dir, HINT_FILE), app.config['HINT_INFO']['sha256'])
     elif filename == 'query_items':
-        file_path = QUERYABLE_ITEMS_FILE
-    else:
-        return "File not found", 404
-    retries = 5
-    while retries > 0:
-        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-            try:
-                return send_file(file_path, as_attachment=True)
-            except Exception as e:
-                return f"Error sending file: {e}", 500
-        time.sleep(1);
-        retries -= 1
-    return "File not ready", 408
+        # Fixed-width records after a .npy header, so clients can sample items by byte range.
+        if app.config.get('MANIFEST') is None: return "File not ready", 408
+        return send_file_range(*current_items_file())
+    return "File not found", 404
+
+def send_file_range(path, etag, chunk_size=HINT_CHUNK_SIZE):
+    # Streams path, or the single byte range asked for, in chunk_size reads so an interrupted
+    # transfer can be resumed from where it stopped.
+    size = os.path.getsize(path)
+    byte_range = request.range.range_for_length(size) if request.range else None
+    if request.range and byte_range is None: return "Requested range not satisfiable", 416
+    start, stop = byte_range or (0, size)
+
+    def generate():
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk: break
+                remaining -= len(chunk)
+                yield chunk
+
+    response = Response(generate(), status=206 if byte_range else 200, mimetype='application/octet-stream')
+    response.headers.update({'Accept-Ranges': 'bytes', 'Content-Length': str(stop - start), 'ETag': f'"{etag}"'})
+    if byte_range: response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    return response
+
+@app.route('/hint-meta', methods=['GET'])
+def hint_meta():
+    if 'HINT_INFO' not in app.config: return jsonify({"error": "Data not preprocessed"}), 400
+    with UPDATE_GATE.shared():
+        return jsonify({'sha256': app.config['HINT_INFO']['sha256'], 'size': app.config['HINT_INFO']['size'],
+                        'epoch': app.config['EPOCH']})
+
+@app.route('/lwe-seed', methods=['GET'])
+def handle_lwe_seed():
+    lwe_seed = app.config.get('LWE_SEED')
+    if lwe_seed is None: return jsonify({"error": "Database not ready"}), 400
+    response = make_response(lwe_seed)
+    response.content_type = shared_logic.WIRE_CONTENT_TYPE
+    return response
 
 @app.route('/ot-setup', methods=['GET'])
 def handle_ot_setup():
     return jsonify({"encrypted_index_list": app.config.get('ENCRYPTED_INDEX_LIST', [])})
 
+@app.route('/ot-table', methods=['GET'])
+def handle_ot_table():
+    ot_table = app.config.get('OT_TABLE')
+    if ot_table is None: return jsonify({"error": "Database not ready"}), 400
+    response = make_response(ot_table)
+    response.content_type = shared_logic.WIRE_CONTENT_TYPE
+    # The table only changes when rows are added, so it is cached across updates that leave the layout alone.
+    response.set_etag(str(app.config['LAYOUT_EPOCH']))
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def _db_block_product(left, limbs, db_matrix, start, end, out):
+    scratch_shape = (db_matrix.shape[0], app.config['CHUNK_SIZE'])
+    scratch = getattr(_scratch, 'db_block', None)
+    if scratch is None or scratch.shape != scratch_shape:
+        scratch = _scratch.db_block = np.empty(scratch_shape, dtype=np.float64)
+    shared_logic.matmul_mod_q(left, db_matrix[:, start:end], out=out[:, start:end], limbs=limbs, scratch=scratch)
+
+def mod_q_product(left, db_matrix, out=None):
+    # left @ db_matrix mod Q with the column blocks spread over the worker pool; every worker reads the same
+    # DB_MATRIX and limb buffer in place, so nothing is copied per worker beyond its own column block.
+    num_cols = db_matrix.shape[1]
+    if out is None: out = np.zeros((left.shape[0], num_cols), dtype=np.uint32)
+    limbs = shared_logic.split_limbs(left)
+    with WORKER_POOL_LOCK:
+        pool, chunk_size = app.config['WORKER_POOL'], app.config['CHUNK_SIZE']
+        futures = [pool.submit(_db_block_product, left, limbs, db_matrix, i, min(i + chunk_size, num_cols), out)
+                   for i in range(0, num_cols, chunk_size)]
+    for future in futures: future.result()
+    return out
+
+def compute_hint(seed, db_matrix):
+    # hint = A @ DB mod Q, accumulated over blocks of A's columns (= DB's rows) expanded from the seed.
+    hint = np.zeros((shared_logic.LWE_N, db_matrix.shape[1]), dtype=np.uint32)
+    partial = np.empty_like(hint)
+    for row_start, row_end, A_T_block in shared_logic.iter_lwe_matrix_A_blocks(seed, db_matrix.shape[0]):
+        mod_q_product(A_T_block.T, db_matrix[row_start:row_end], out=partial)
+        shared_logic.add_mod_q(hint, partial, out=hint)
+    return hint
+
+def compute_answers(qu_matrix, db_matrix):
+    # One pass over the database for all k queries: each column block is read once and multiplied by every row of Q.
+    return mod_q_product(qu_matrix, db_matrix)
+
+def forward_answers(ans_matrix, transaction_ids, epoch):
+    # Queues the answers for Server2 and returns the payload bytes they will take on the wire.
+    FORWARDER.submit(ans_matrix, transaction_ids, epoch)
+    return (ans_matrix.size * min(ANS_WIRE_BITS or 32, 32) + 7) // 8
+
+def shard_row_range(num_rows, index, count):
+    return num_rows * index // count, num_rows * (index + 1) // count
+
+def post_partial_answer(url, qu_part, meta):
+    response = SHARD_SESSION.post(f"{url}/partial-answer", data=shared_logic.encode_array(qu_part, meta,
+                                                                                         bits=ANS_WIRE_BITS),
+                                  headers={'Content-Type': shared_logic.WIRE_CONTENT_TYPE}, timeout=SHARD_TIMEOUT)
+    if response.status_code == 409: return None
+    response.raise_for_status()
+    return shared_logic.decode_array(response.content)[0]
+
+def gather_shard_answers(qu_matrix):
+    # Each shard multiplies its slice of qu by its own row range of DB; the partial answers sum to qu @ DB mod Q.
+    # A shard still on an older epoch answers 409: all shards are told to reload and the query is retried once.
+    urls = app.config['SHARD_URLS']
+    num_rows, epoch = qu_matrix.shape[1], app.config['EPOCH']
+    ranges = [shard_row_range(num_rows, i, len(urls)) for i in range(len(urls))]
+    for attempt in range(2):
+        futures = [app.config['SHARD_POOL'].submit(post_partial_answer, url, qu_matrix[:, start:end],
+                                                    {'row_start': start, 'row_end': end, 'epoch': epoch})
+                   for url, (start, end) in zip(urls, ranges)]
+        partials = [future.result() for future in futures]
+        if all(partial is not None for partial in partials): break
+        if attempt == 0: notify_shards()
+    else:
+        raise requests.exceptions.RequestException(f"shards did not reach epoch {epoch}")
+    ans = np.array(partials[0], dtype=np.uint32)
+    for partial in partials[1:]: shared_logic.add_mod_q(ans, partial, out=ans)
+    return ans
+
+def answer_queries(qu_matrix):
+    if app.config['SHARD_URLS']: return gather_shard_answers(qu_matrix)
+    return compute_answers(qu_matrix, app.config['DB_MATRIX'])
+
+def notify_shards():
+    # Shards map the same snapshot directory; after it changes they re-read CURRENT and its manifest.
+    for url in app.config['SHARD_URLS']:
+        try:
+            SHARD_SESSION.post(f"{url}/reload", timeout=SHARD_TIMEOUT).raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print(f"S1: 通知分片 {url} 重新加载失败: {e}")
+
+@app.route('/partial-answer', methods=['POST'])
+def partial_answer():
+    if app.config.get('DB_MATRIX') is None: return jsonify({"error": "Database not ready"}), 400
+    with METRICS.stage('deserialize'):
+        qu_part, meta = shared_logic.decode_array(request.get_data())
+    row_start, row_end = meta['row_start'], meta['row_end']
+    with UPDATE_GATE.shared():
+        if meta['epoch'] != app.config['EPOCH']:
+            return jsonify({"error": "shard epoch mismatch", "epoch": app.config['EPOCH']}), 409
+        num_rows = app.config['DB_MATRIX'].shape[0]
+        if app.config['SHARD_COUNT'] and (row_start, row_end) != shard_row_range(
+                num_rows, app.config['SHARD_INDEX'], app.config['SHARD_COUNT']):
+            return jsonify({"error": "row range does not match this shard"}), 400
+        if qu_part.ndim != 2 or qu_part.shape[1] != row_end - row_start or row_end > num_rows:
+            return jsonify({"error": "qu slice does not match the row range"}), 400
+        with METRICS.stage('matrix_product'):
+            ans = compute_answers(qu_part, app.config['DB_MATRIX'][row_start:row_end])
+    with METRICS.stage('serialize'):
+        response = make_response(shared_logic.encode_array(ans, bits=ANS_WIRE_BITS))
+    response.content_type = shared_logic.WIRE_CONTENT_TYPE
+    return response
+
+@app.route('/reload', methods=['POST'])
+def reload_snapshot():
+    with UPDATE_GATE.exclusive():
+        loaded = load_current_snapshot()
+    if not loaded: return jsonify({"error": "no snapshot to load"}), 404
+    return jsonify({"status": "reloaded", "epoch": app.config['EPOCH']})
+
+@app.route('/config', methods=['GET', 'POST'])
+def handle_config():
+    if request.method == 'POST':
+        data = request.json or {}
+        if 'chunk_size' in data:
+            app.config['CHUNK_SIZE'] = max(1, int(data['chunk_size']))
+        if 'workers' in data and int(data['workers']) != app.config['WORKER_COUNT']:
+            with WORKER_POOL_LOCK:
+                old_pool = app.config['WORKER_POOL']
+                app.config['WORKER_COUNT'] = max(1, int(data['workers']))
+                app.config['WORKER_POOL'] = ThreadPoolExecutor(max_workers=app.config['WORKER_COUNT'])
+                old_pool.shutdown(wait=False)
+    return jsonify({"workers": app.config['WORKER_COUNT'], "chunk_size": app.config['CHUNK_SIZE']})
+
+def is_stale_query(qu, meta):
+    # Queries built for an older row layout (spill rows added, or a rebuild under a new seed) cannot be answered.
+    layout_epoch = app.config['LAYOUT_EPOCH']
+    return qu.shape[-1] != app.config['DB_MATRIX'].shape[0] or meta.get('epoch', layout_epoch) < layout_epoch
+
+def stale_query_response():
+    return jsonify({"error": "database layout changed; refresh db_params", "db_params": app.config['DB_PARAMS']}), 409
 
 @app.route('/compute-answer', methods=['POST'])
 def compute_answer():
     db_matrix = app.config.get('DB_MATRIX')
     if db_matrix is None: return jsonify({"error": "Database not ready"}), 400
-    data = request.json;
-    qu = np.array(data['qu'], dtype=np.uint32);
-    transaction_id = data['transaction_id']
+    with METRICS.stage('deserialize'):
+        qu, meta = shared_logic.decode_vector_payload(request.mimetype, request.get_data(), 'qu')
+    transaction_id = meta['transaction_id']
+    with UPDATE_GATE.shared():
+        if is_stale_query(qu, meta): return stale_query_response()
+        try:
+            with METRICS.stage('matrix_product') as timer:
+                ans = answer_queries(qu.reshape(1, -1))
+        except requests.exceptions.RequestException as e:
+            return jsonify({"status": "shard request failed", "details": str(e)}), 502
+        epoch = app.config['EPOCH']
+    try:
+        ans_bytes = forward_answers(ans, [transaction_id], epoch)
+    except queue.Full:
+        return jsonify({"status": "forward queue to s2 is full"}), 503
+    METRICS.inc('queries_total')
+    return jsonify({"status": "ans computed", "core_computation_time": timer.elapsed,
+                    "ans_bytes": ans_bytes})
+
+@app.route('/compute-answer-batch', methods=['POST'])
+def compute_answer_batch():
+    db_matrix = app.config.get('DB_MATRIX')
+    if db_matrix is None: return jsonify({"error": "Database not ready"}), 400
+    with METRICS.stage('deserialize'):
+        qu_matrix, meta = shared_logic.decode_vector_payload(request.mimetype, request.get_data(), 'qu')
+    transaction_ids = meta['transaction_ids']
+    if qu_matrix.ndim != 2 or qu_matrix.shape[0] != len(transaction_ids):
+        return jsonify({"error": "qu must be a (k, num_rows) stack matching transaction_ids"}), 400
+    with UPDATE_GATE.shared():
+        if is_stale_query(qu_matrix, meta): return stale_query_response()
+        try:
+            with METRICS.stage('matrix_product') as timer:
+                ans = answer_queries(qu_matrix)
+        except requests.exceptions.RequestException as e:
+            return jsonify({"status": "shard request failed", "details": str(e)}), 502
+        epoch = app.config['EPOCH']
+    try:
+        ans_bytes = forward_answers(ans, transaction_ids, epoch)
+    except queue.Full:
+        return jsonify({"status": "forward queue to s2 is full"}), 503
+    METRICS.inc('queries_total', len(transaction_ids))
+    return jsonify({"status": "ans computed", "batch_size": len(transaction_ids),
+                    "core_computation_time": timer.elapsed, "ans_bytes": ans_bytes})
+
+def hex_items_to_array(hex_items, entry_len):
+    if any(len(h) != 2 * entry_len for h in hex_items):
+        raise ValueError(f"every hash must be {entry_len} bytes")
+    return np.frombuffer(bytes.fromhex(''.join(hex_items)), dtype=np.uint8).reshape(len(hex_items), entry_len)
+
+def drop_items(items, removed):
+    # items without the rows equal to a row of removed. Matching row_keys narrow down the rows compared in full.
+    if not len(removed): return items
+    candidates = np.flatnonzero(np.isin(shared_logic.row_keys(items), shared_logic.row_keys(removed)))
+    removed_set = {item.tobytes() for item in removed}
+    drop = [i for i in candidates if items[i].tobytes() in removed_set]
+    return np.delete(items, drop, axis=0) if drop else items
+
+def current_items(snapshot_dir):
+    # The snapshot's items (memory-mapped) with its update log replayed on top. The log only ever removes
+    # present items and adds absent ones, so it reduces to the base items to drop and the additions to append.
+    items = np.load(os.path.join(snapshot_dir, QUERYABLE_ITEMS_FILE), mmap_mode='r')
+    with open(os.path.join(snapshot_dir, UPDATES_FILE)) as f: update_log = json.load(f)
+    if not update_log: return items
+    gone, added = set(), {}
+    for entry in update_log:
+        for h in entry['remove']:
+            if added.pop(h, False) is False: gone.add(h)
+        for h in entry['add']: added[h] = None
+    entry_len = items.shape[1]
+    return np.concatenate([drop_items(items, hex_items_to_array(sorted(gone), entry_len)),
+                           hex_items_to_array(list(added), entry_len)])
+
+def current_items_file():
+    # Path and ETag of the item file for the served epoch. After an update it is written on first use and
+    # replaces the files of earlier epochs.
+    with UPDATE_GATE.shared():
+        snapshot_dir, manifest = app.config['SNAPSHOT_DIR'], app.config['MANIFEST']
+        etag = f"{manifest['lwe_seed'][:16]}-{manifest['epoch']}"
+        if manifest['epoch'] == manifest['build_epoch']: return os.path.join(snapshot_dir, QUERYABLE_ITEMS_FILE), etag
+        path = os.path.join(snapshot_dir, EPOCH_ITEMS_FILE.format(epoch=manifest['epoch']))
+        with ITEMS_FILE_LOCK:
+            if not os.path.exists(path):
+                shared_logic.save_hash_file(path, current_items(snapshot_dir))
+                for name in os.listdir(snapshot_dir):
+                    if name.startswith("queryable_items.e") and name != os.path.basename(path):
+                        os.remove(os.path.join(snapshot_dir, name))
+    return path, etag
+
+def plan_update(added, removed):
+    # Works out the new contents of every touched row in memory, without changing anything yet. Items stay
+    # packed at the front of their row (a removal moves the row's last item into the hole) and freed or new
+    # slots are zero, so only the touched slots' columns change. A prefix the database has never seen gets a
+    # new spill row appended after the existing ones. Additions that find their row full are returned in
+    # 'overflow' for a compaction to add.
+    db_params = app.config['DB_PARAMS']
+    max_cols, entry_len = db_params['max_cols_per_row'], db_params['entry_vec_len']
+    prefix_bits = db_params['prefix_bits']
+    db_matrix = app.config['DB_MATRIX']
+    num_rows = db_matrix.shape[0]
+    row_of = {int(p, 16): i for i, p in enumerate(app.config['PREFIX_LIST'])}
+    row_counts = list(app.config['ROW_COUNTS'])
+    rows, new_prefixes, applied, overflow = {}, [], {'add': [], 'remove': []}, []
+
+    def row_slots(r):
+        if r not in rows:
+            rows[r] = (np.array(db_matrix[r]) if r < num_rows else np.zeros(db_matrix.shape[1], dtype=np.uint8)
+                       ).reshape(max_cols, entry_len)
+        return rows[r]
+
+    for item, prefix in zip(removed, shared_logic.prefix_values(removed, prefix_bits).tolist()):
+        r = row_of.get(prefix)
+        if r is None: continue
+        slots, n = row_slots(r), row_counts[r]
+        hits = np.flatnonzero(np.all(slots[:n] == item, axis=1))
+        if not len(hits): continue
+        slots[hits[0]] = slots[n - 1]
+        slots[n - 1] = 0
+        row_counts[r] -= 1
+        applied['remove'].append(item.tobytes().hex())
+    for item, prefix in zip(added, shared_logic.prefix_values(added, prefix_bits).tolist()):
+        r = row_of.get(prefix)
+        if r is None:
+            r = row_of[prefix] = num_rows + len(new_prefixes)
+            new_prefixes.append(prefix)
+            row_counts.append(0)
+        slots, n = row_slots(r), row_counts[r]
+        if np.any(np.all(slots[:n] == item, axis=1)): continue
+        if n == max_cols:
+            overflow.append(item)
+            continue
+        slots[n] = item
+        row_counts[r] += 1
+        applied['add'].append(item.tobytes().hex())
+    return {'rows': rows, 'new_prefixes': new_prefixes, 'row_counts': np.array(row_counts, dtype=np.int64),
+            'applied': applied, 'overflow': np.array(overflow, dtype=np.uint8).reshape(-1, entry_len)}
+
+def hint_delta_for(plan):
+    # Sparse change to hint = A @ DB: only the columns where some touched row changed, each getting
+    # sum_r A[:, r] * (new - old)[r, c] mod Q, with A's columns for the touched rows expanded from the seed.
+    # Only the changed (row, column) slots are widened to compute their differences.
+    db_matrix = app.config['DB_MATRIX']
+    touched = sorted(plan['rows'])
+    if not touched: return np.zeros(0, dtype=np.int64), np.zeros((shared_logic.LWE_N, 0), dtype=np.uint32)
+    slot_rows, slot_cols, slot_diffs = [], [], []
+    for i, r in enumerate(touched):
+        new = plan['rows'][r].reshape(-1)
+        old = db_matrix[r] if r < db_matrix.shape[0] else np.zeros_like(new)
+        changed = np.flatnonzero(new != old)
+        slot_rows.append(np.full(len(changed), i))
+        slot_cols.append(changed)
+        slot_diffs.append((new[changed].astype(np.int64) - old[changed]) % shared_logic.LWE_Q)
+    slot_cols = np.concatenate(slot_cols)
+    columns = np.unique(slot_cols)
+    diff = np.zeros((len(touched), len(columns)), dtype=np.uint32)
+    diff[np.concatenate(slot_rows), np.searchsorted(columns, slot_cols)] = np.concatenate(slot_diffs)
+    A_T = np.concatenate([shared_logic.expand_lwe_matrix_A_T(app.config['LWE_SEED'], r, r + 1) for r in touched])
+    return columns, shared_logic.matmul_mod_q(np.ascontiguousarray(A_T.T), diff)
+
+def patched_npy_digest(path, patch_block, block_bytes=HINT_CHUNK_SIZE):
+    # Manifest entry of the .npy file at path as it will be once patch_block(start, block) has patched every
+    # block of rows, computed from the current file without writing anything.
+    array = np.load(path, mmap_mode='r')
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f: digest.update(f.read(array.offset))
+    block_rows = max(1, block_bytes // max(1, array[:1].nbytes))
+    for start in range(0, array.shape[0], block_rows):
+        block = np.array(array[start:start + block_rows])
+        patch_block(start, block)
+        digest.update(block)
+    return {'sha256': digest.hexdigest(), 'size': os.path.getsize(path)}
+
+def stage_update(plan):
+    # The O(database) part of an update, done before the gate is taken while answers go on (the caller
+    # holds WRITER_LOCK, so the files cannot change meanwhile): the hint delta, a grown copy of the DB
+    # matrix when spill rows are added, and the digests the DB matrix and hint will have once patched.
+    snapshot_dir = app.config['SNAPSHOT_DIR']
+    columns, delta = hint_delta_for(plan)
+    db_path = os.path.join(snapshot_dir, DB_MATRIX_FILE)
+    old_rows, num_cols = app.config['DB_MATRIX'].shape
+    num_rows = old_rows + len(plan['new_prefixes'])
+    grown_path = None
+    if num_rows > old_rows:
+        grown_path = db_path + '.tmp'
+        grown = np.lib.format.open_memmap(grown_path, mode='w+', dtype=np.uint8, shape=(num_rows, num_cols))
+        grown[:old_rows] = app.config['DB_MATRIX']
+        grown[old_rows:] = 0
+        for r, slots in plan['rows'].items(): grown[r] = slots.reshape(-1)
+        grown.flush()
+        del grown
+        db_digest = {'sha256': shared_logic.file_sha256(grown_path), 'size': os.path.getsize(grown_path)}
+    else:
+        def patch_rows(start, block):
+            for r, slots in plan['rows'].items():
+                if start <= r < start + len(block): block[r - start] = slots.reshape(-1)
+        db_digest = patched_npy_digest(db_path, patch_rows)
+
+    def patch_hint(start, block):
+        block[:, columns] = shared_logic.add_mod_q(block[:, columns], delta[start:start + len(block)],
+                                                   out=np.empty((len(block), len(columns)), dtype=delta.dtype))
+    hint_digest = patched_npy_digest(os.path.join(snapshot_dir, HINT_FILE), patch_hint)
+    return {'columns': columns, 'delta': delta, 'num_rows': num_rows, 'grown_path': grown_path,
+            'digests': {DB_MATRIX_FILE: db_digest, HINT_FILE: hint_digest}}
+
+def apply_update(plan, staged):
+    # Writes a planned update, staged by stage_update, into the active snapshot: touched DB rows and hint
+    # columns are patched in place, spill rows swap in the grown DB matrix and extend the OT table, and the
+    # manifest is rewritten last. While the patch is in progress the manifest is marked 'updating', so a
+    # crash leaves a snapshot load_snapshot rejects.
+    snapshot_dir = app.config['SNAPSHOT_DIR']
+    manifest = app.config['MANIFEST']
+    columns, delta, num_rows = staged['columns'], staged['delta'], staged['num_rows']
+    epoch = app.config['EPOCH'] + 1
+    manifest['updating'] = True
+    write_manifest(snapshot_dir, manifest)
+    changed_files = [ROW_COUNTS_FILE, UPDATES_FILE]
+
+    db_path = os.path.join(snapshot_dir, DB_MATRIX_FILE)
+    old_rows = app.config['DB_MATRIX'].shape[0]
+    if staged['grown_path']:
+        os.replace(staged['grown_path'], db_path)
+    else:
+        db_matrix = np.load(db_path, mmap_mode='r+')
+        for r, slots in plan['rows'].items(): db_matrix[r] = slots.reshape(-1)
+        db_matrix.flush()
+        del db_matrix
+    hint = np.load(os.path.join(snapshot_dir, HINT_FILE), mmap_mode='r+')
+    hint[:, columns] = shared_logic.add_mod_q(hint[:, columns], delta, out=np.empty_like(delta))
+    hint.flush()
+    del hint
+
+    prefix_len = shared_logic.prefix_nbytes(manifest['db_params']['prefix_bits'])
+    prefix_list = app.config['PREFIX_LIST'] + [f"{p:0{2 * prefix_len}x}" for p in plan['new_prefixes']]
+    encrypted_list = app.config['ENCRYPTED_INDEX_LIST'] + [
+        shared_logic.encrypt_index(shared_logic.get_key_from_prefix(p.to_bytes(prefix_len, 'big')), r)
+        for r, p in enumerate(plan['new_prefixes'], start=old_rows)]
+    layout_epoch = manifest['layout_epoch']
+    if plan['new_prefixes']:
+        layout_epoch = epoch
+        np.save(os.path.join(snapshot_dir, PREFIX_FILE), np.array([int(p, 16) for p in prefix_list], dtype=np.uint32))
+        np.save(os.path.join(snapshot_dir, ENCRYPTED_INDEX_FILE), np.array([t.encode('utf-8') for t in encrypted_list]))
+        with open(os.path.join(snapshot_dir, OT_TABLE_FILE), 'wb') as f:
+            f.write(shared_logic.build_ot_table(prefix_list, encrypted_list, epoch))
+        changed_files += [PREFIX_FILE, ENCRYPTED_INDEX_FILE, OT_TABLE_FILE]
+    np.save(os.path.join(snapshot_dir, ROW_COUNTS_FILE), plan['row_counts'])
+    with open(os.path.join(snapshot_dir, UPDATES_FILE)) as f: update_log = json.load(f)
+    update_log.append({'epoch': epoch, **plan['applied']})
+    with open(os.path.join(snapshot_dir, UPDATES_FILE), 'w') as f: json.dump(update_log, f)
+
+    manifest.pop('updating')
+    manifest.update({'epoch': epoch, 'layout_epoch': layout_epoch,
+                     'db_params': {**manifest['db_params'], 'num_rows': num_rows, 'epoch': epoch,
+                                   'padding_ratio': padding_ratio(int(plan['row_counts'].sum()), num_rows,
+                                                                  manifest['db_params']['max_cols_per_row'])}})
+    write_manifest(snapshot_dir, manifest, changed_files, staged['digests'])
+    deltas = app.config['HINT_DELTAS'] + [{'epoch': epoch, 'columns': columns, 'delta': delta}]
+    snapshot = load_snapshot(snapshot_dir, verify=False)
+    activate_snapshot(snapshot)
+    app.config['HINT_DELTAS'] = deltas[-HINT_DELTA_HISTORY:]
+    return {'epoch': epoch, 'changed_rows': len(plan['rows']), 'spill_rows': len(plan['new_prefixes']),
+            'hint_columns': len(columns), 'added': len(plan['applied']['add']),
+            'removed': len(plan['applied']['remove'])}
+
+def compact_snapshot(batches):
+    # Full rebuild from the current item set with `batches` of (added, removed) applied in order: spill rows
+    # are folded back into prefix order and the rows refitted, under a new seed and epoch. It is built in a
+    # staging directory while answers keep using the live snapshot, which is only swapped out at the end.
+    # Server2 and clients re-download everything, as after /preprocess.
+    snapshot_dir, manifest = app.config['SNAPSHOT_DIR'], app.config['MANIFEST']
+    items = current_items(snapshot_dir)
+    for added, removed in batches:
+        items = shared_logic.distinct_rows(np.concatenate([drop_items(items, removed), added]))
+    staging_dir = build_snapshot(snapshot_dir, manifest['num_entries'], items, manifest['input_checksum'],
+                                 staging_suffix=".compact")
+    with WRITER_LOCK, UPDATE_GATE.exclusive():
+        install_snapshot(staging_dir, snapshot_dir)
+        activate_snapshot(load_snapshot(snapshot_dir, verify=False))
+    print(f"S1: 压缩完成, epoch {app.config['EPOCH']}, {len(items)} 项")
+
+def run_compaction(batches):
+    # Body of the background compaction thread. Batches /update queued meanwhile are then applied in place;
+    # if some of their additions overflow too, they go into another round.
+    # Every batch here was acknowledged to its client, so none is dropped: a failed rebuild is retried with the
+    # same batches, and a queued batch that fails to apply goes into the next rebuild, which applies it whole.
+    while True:
+        try:
+            compact_snapshot(batches)
+        except Exception as e:
+            print(f"S1 compaction failed: {traceback.format_exc()}")
+            with WRITER_LOCK:
+                COMPACTION['failures'] += 1
+                COMPACTION['last_error'] = f"{type(e).__name__}: {e}"
+            time.sleep(COMPACTION_RETRY_DELAY)
+            continue
+        with WRITER_LOCK:
+            COMPACTION['last_error'] = None
+            queued, COMPACTION['queued'] = COMPACTION['queued'], []
+            batches = []
+            for added, removed in queued:
+                try:
+                    batches += apply_batch(added, removed)[1]
+                except Exception:
+                    print(f"S1 CRASHED: {traceback.format_exc()}")
+                    batches.append((added, removed))
+            if not batches: COMPACTION['thread'] = None
+        notify_shards()
+        if not batches: return
+
+def start_compaction(batches):
+    # Caller holds WRITER_LOCK.
+    COMPACTION['thread'] = threading.Thread(target=run_compaction, args=(batches,), daemon=True)
+    COMPACTION['thread'].start()
+
+def apply_batch(added, removed):
+    # Patches the active snapshot with whatever fits; returns the result and the overflowing additions as
+    # a batch list for compaction. Caller holds WRITER_LOCK.
+    plan = plan_update(added, removed)
+    if plan['applied']['add'] or plan['applied']['remove']:
+        staged = stage_update(plan)
+        with UPDATE_GATE.exclusive():
+            result = apply_update(plan, staged)
+    else:
+        result = {'epoch': app.config['EPOCH'], 'changed_rows': 0, 'spill_rows': 0, 'hint_columns': 0, 'added': 0,
+                  'removed': 0}
+    result['deferred'] = len(plan['overflow'])
+    return result, [(plan['overflow'], plan['overflow'][:0])] if len(plan['overflow']) else []
+
+@app.route('/update', methods=['POST'])
+def update_database():
+    # {"add": [hex...], "remove": [hex...], "compact": false}. Removals are applied before additions.
+    # Additions whose row is full, and "compact": true, start a background compaction; while one runs,
+    # batches are queued (202) and applied after it.
+    if app.config.get('DB_MATRIX') is None: return jsonify({"error": "Database not ready"}), 400
+    data = request.json or {}
+    entry_len = app.config['DB_PARAMS']['entry_vec_len']
+    try:
+        added = hex_items_to_array(data.get('add', []), entry_len)
+        removed = hex_items_to_array(data.get('remove', []), entry_len)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     start_time = time.time()
-    chunk_size = 256;
-    num_cols = db_matrix.shape[1]
-    ans = np.zeros(num_cols, dtype=np.uint32)
-    qu_i64 = qu.astype(np.int64)
-    for i in range(0, num_cols, chunk_size):
-        end = min(i + chunk_size, num_cols)
-        db_chunk = db_matrix[:, i:end]
-        ans_chunk = (qu_i64 @ db_chunk.astype(np.int64)) % shared_logic.LWE_Q
-        ans[i:end] = ans_chunk
-    core_computation_time = time.time() - start_time
     try:
-        requests.post(f"http://{S2_IP}:{S2_PORT}/receive-ans",
-                      json={'ans': ans.tolist(), 'transaction_id': transaction_id}, timeout=10)
-    except requests.exceptions.RequestException:
-        return jsonify({"status": "failed to forward to s2"}), 500
-    return jsonify({"status": "ans computed", "core_computation_time": core_computation_time})
+        with WRITER_LOCK:
+            if COMPACTION['thread'] is not None:
+                COMPACTION['queued'].append((added, removed))
+                return jsonify({"status": "update queued", "compacting": True,
+                                "queued_batches": len(COMPACTION['queued']),
+                                "compaction_error": COMPACTION['last_error']}), 202
+            if data.get('compact'):
+                print("S1: 请求压缩，正在后台重建预处理快照...")
+                start_compaction([(added, removed)])
+                return jsonify({"status": "compaction started", "compacting": True}), 202
+            result, overflow = apply_batch(added, removed)
+            if overflow:
+                print("S1: 行容量不足，正在后台重建预处理快照...")
+                start_compaction(overflow)
+            result['compacting'] = COMPACTION['thread'] is not None
+    except Exception as e:
+        print(f"S1 CRASHED: {traceback.format_exc()}")
+        return jsonify({"error": "S1 internal server error", "details": str(e)}), 500
+    notify_shards()
+    result['time'] = time.time() - start_time
+    return jsonify({"status": "update applied", **result})
+
+@app.route('/hint-delta', methods=['GET'])
+def hint_delta():
+    # The hint columns that changed after epoch `since`, summed over every update since then. 410 means the
+    # deltas are not available (a rebuild, a restart, or too old) and the whole hint has to be downloaded.
+    if 'HINT_INFO' not in app.config: return jsonify({"error": "Data not preprocessed"}), 400
+    since = int(request.args['since'])
+    # Read under the gate so a concurrent update or compaction cannot mix two epochs into one delta.
+    with UPDATE_GATE.shared():
+        deltas = [d for d in app.config['HINT_DELTAS'] if d['epoch'] > since]
+        covered = since >= app.config['MANIFEST']['build_epoch'] and (
+            since == app.config['EPOCH'] or (deltas and deltas[0]['epoch'] == since + 1))
+        if not covered: return jsonify({"error": "hint delta not available; download the hint"}), 410
+        columns = (np.unique(np.concatenate([d['columns'] for d in deltas])) if deltas
+                   else np.zeros(0, dtype=np.int64))
+        total = np.zeros((shared_logic.LWE_N, len(columns)), dtype=np.uint32)
+        for d in deltas:
+            idx = np.searchsorted(columns, d['columns'])
+            total[:, idx] = shared_logic.add_mod_q(total[:, idx], d['delta'], out=np.empty_like(d['delta']))
+        body = shared_logic.encode_array(total, {'columns': columns.tolist(), 'from_epoch': since,
+                                                 'to_epoch': app.config['EPOCH'],
+                                                 'sha256': app.config['HINT_INFO']['sha256']})
+    response = make_response(body)
+    response.content_type = shared_logic.WIRE_CONTENT_TYPE
+    return response
+
+@app.route('/db-params', methods=['GET'])
+def handle_db_params():
+    if app.config.get('DB_PARAMS') is None: return jsonify({"error": "Database not ready"}), 400
+    return jsonify({"db_params": app.config['DB_PARAMS'], "layout_epoch": app.config['LAYOUT_EPOCH'],
+                    "compacting": COMPACTION['thread'] is not None, "compaction_error": COMPACTION['last_error']})
+
+def load_current_snapshot():
+    current_path = os.path.join(SNAPSHOT_ROOT, "CURRENT")
+    if not os.path.exists(current_path): return False
+    with open(current_path) as f: snapshot_dir = os.path.join(SNAPSHOT_ROOT, f.read().strip())
+    snapshot = load_snapshot(snapshot_dir, verify=SNAPSHOT_VERIFY_ON_START)
+    if snapshot is None: return False
+    activate_snapshot(snapshot)
+    return True
+
+def spawn_local_shards(count, first_port):
+    # Starts `count` shard processes of this script on localhost; they are terminated when this process exits.
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--port', str(first_port + i),
+                                   '--shard-index', str(i), '--shard-count', str(count)])
+                 for i in range(count)]
+    atexit.register(lambda: [process.terminate() for process in processes])
+    # atexit handlers do not run when killed by SIGTERM; turn it into a normal exit.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    return [f"http://127.0.0.1:{first_port + i}" for i in range(count)]
 
 if __name__ == '__main__':
-    print(f"Server1 正在 http://0.0.0.0:{SERVER1_PORT} 上运行...")
+    parser = argparse.ArgumentParser(description="Server1: 在数据库上计算 qu·DB")
+    parser.add_argument('--port', type=int, default=SERVER1_PORT)
+    parser.add_argument('--shard-index', type=int, help="作为分片运行, 只负责第 i 段行")
+    parser.add_argument('--shard-count', type=int, help="分片总数")
+    parser.add_argument('--shards', help="作为协调者运行: 逗号分隔的分片地址")
+    parser.add_argument('--spawn-shards', type=int, default=0, help="在本机启动 N 个分片进程")
+    parser.add_argument('--shard-port', type=int, help="本机分片的起始端口 (与 --spawn-shards 一起必填)")
+    args = parser.parse_args()
+    if (args.shard_index is None) != (args.shard_count is None):
+        parser.error("--shard-index and --shard-count go together")
+    app.config.update({'SHARD_INDEX': args.shard_index, 'SHARD_COUNT': args.shard_count})
+    if args.shards: app.config['SHARD_URLS'] = [url.strip().rstrip('/') for url in args.shards.split(',')]
+    if args.spawn_shards:
+        # No default: the ports right after Server1's are where Server2 usually listens.
+        if args.shard_port is None: parser.error("--spawn-shards needs --shard-port")
+        shard_ports = range(args.shard_port, args.shard_port + args.spawn_shards)
+        if args.port in shard_ports or S2_PORT in shard_ports:
+            parser.error(f"shard ports {shard_ports.start}-{shard_ports.stop - 1} overlap Server1's or Server2's port")
+        app.config['SHARD_URLS'] += spawn_local_shards(args.spawn_shards, args.shard_port)
+    if app.config['SHARD_URLS']:
+        app.config['SHARD_POOL'] = ThreadPoolExecutor(max_workers=4 * len(app.config['SHARD_URLS']))
+    if load_current_snapshot():
+        print(f"S1: 已加载预处理快照 {app.config['SNAPSHOT_DIR']} (epoch {app.config['EPOCH']})")
+    if args.shard_count: print(f"S1: 分片 {args.shard_index + 1}/{args.shard_count}")
+    elif app.config['SHARD_URLS']: print(f"S1: 协调 {len(app.config['SHARD_URLS'])} 个分片")
+    print(f"Server1 正在 http://0.0.0.0:{args.port} 上运行...")
     from waitress import serve
 
-    serve(app, host='0.0.0.0', port=SERVER1_PORT)
+    serve(app, host='0.0.0.0', port=args.port)
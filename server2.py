@@ -3,121 +3,283 @@ import numpy as np
 import os
 import time
 import requests
-from flask import Flask, request, jsonify, send_file
-from pybloom_live import BloomFilter
-import random
+from flask import Flask, request, jsonify, Response
 import json
+import threading
+import functools
 
 import shared_logic
+from transaction_store import TransactionStore
 
 
 S1_IP = "192.168.1.101"
 S1_PORT = 5001
 SERVER2_PORT = 5002
 HINT_FILE = "hint_matrix.npy"
-BF_FILE_NAME_TEMPLATE = "bf_{}.bin"
+# Holds the sha256 of a fully downloaded and verified HINT_FILE; a partial download lives in HINT_FILE + '.part'.
+HINT_SHA_FILE = "hint_matrix.sha256"
+HINT_CHUNK_SIZE = 1 << 20
+HINT_DOWNLOAD_ATTEMPTS = 3
+# Membership filter returned by /download-bf: 'fingerprint' (sorted truncated hashes) or 'bloom'. Both can be
+# overridden per transaction through /setup-verification's filter_kind and fp_rate.
+MEMBERSHIP_FILTER_KIND = 'fingerprint'
+MEMBERSHIP_FP_RATE = 1e-9
 DEBUG_DIR = "debug_files"
+# Longest one request may block waiting for a transaction's s and ans to arrive; the client polls again after a
+# 408 until its own deadline.
+READY_TIMEOUT = 2
+# Transactions not written to for TRANSACTION_TTL seconds are dropped; past TRANSACTION_MAX_BYTES of held
+# state the least recently written ones are evicted.
+TRANSACTION_TTL = 120
+TRANSACTION_MAX_BYTES = 512 * 2 ** 20
+SERVER_THREADS = 32
+# Share of SERVER_THREADS that may block on readiness at once. Past it a waiter gets a 503 and polls, so waiters
+# can never hold every thread the /receive-s and /receive-ans they wait for need.
+READY_WAITER_SHARE = 0.25
 
 app = Flask(__name__)
-TRANSACTION_STORE = {}
-SK_OPRF = random.randint(2, shared_logic.OPRF_GROUP_ORDER - 1)
+TRANSACTION_STORE = TransactionStore(ttl=TRANSACTION_TTL, max_bytes=TRANSACTION_MAX_BYTES)
+SK_OPRF = shared_logic.oprf_generate_key()
+# OPRF outputs of recently recovered DB items; rows are queried again and again, and each miss costs a
+# hash-to-curve and a scalar multiplication.
+OPRF_CACHE_ITEMS = 1 << 18
+# Held while the hint is read for a decryption or patched with a delta from Server1. Reentrant, so a
+# decryption can check its answer's epoch, sync the hint and use it under one hold.
+HINT_LOCK = threading.RLock()
+METRICS = shared_logic.MetricsRegistry('pir_s2')
+METRICS.register_gauges(lambda: {f'transactions_{k}': v for k, v in TRANSACTION_STORE.stats().items()})
+METRICS.register_gauges(lambda: {'oprf_cache_hits': oprf_eval_item.cache_info().hits,
+                                 'oprf_cache_misses': oprf_eval_item.cache_info().misses})
+shared_logic.instrument_app(app, METRICS)
+
+def configure_server_threads(threads):
+    # Sizes the waiter cap for a server run with `threads` worker threads.
+    global SERVER_THREADS, READY_WAITERS
+    SERVER_THREADS = threads
+    READY_WAITERS = threading.BoundedSemaphore(max(1, int(threads * READY_WAITER_SHARE)))
+
+configure_server_threads(SERVER_THREADS)
 
 # setup, receive_s, receive_ans, setup_verification, download_bf 
+def download_hint(s1_url, hint_meta):
+    # Brings HINT_FILE up to date with the hint described by /hint-meta, resuming a partial download with a
+    # Range request and checking the sha256 before it is used. Returns the bytes actually transferred.
+    if os.path.exists(HINT_FILE) and os.path.exists(HINT_SHA_FILE):
+        with open(HINT_SHA_FILE) as f:
+            if f.read().strip() == hint_meta['sha256']: return 0
+    part_file = HINT_FILE + '.part'
+    transferred = 0
+    for attempt in range(HINT_DOWNLOAD_ATTEMPTS):
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        if offset > hint_meta['size']: offset = 0
+        if offset < hint_meta['size']:
+            try:
+                with requests.get(f"{s1_url}/download/hint", headers={'Range': f"bytes={offset}-"}, stream=True,
+                                  timeout=300) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206: offset = 0  # range ignored: the body is the whole file
+                    with open(part_file, 'ab' if offset else 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=HINT_CHUNK_SIZE):
+                            f.write(chunk)
+                            transferred += len(chunk)
+            except requests.exceptions.RequestException as e:
+                print(f"S2: hint下载中断 (第 {attempt + 1} 次), 将断点续传 - {e}")
+                continue
+        complete = os.path.getsize(part_file) == hint_meta['size']
+        if complete and shared_logic.file_sha256(part_file) == hint_meta['sha256']:
+            os.replace(part_file, HINT_FILE)
+            with open(HINT_SHA_FILE, 'w') as f: f.write(hint_meta['sha256'])
+            return transferred
+        os.remove(part_file)  # corrupt, or left over from an older epoch
+    raise IOError(f"hint download failed after {HINT_DOWNLOAD_ATTEMPTS} attempts")
+
+def load_hint(s1_url):
+    # Downloads (or resumes, or reuses) Server1's current hint and maps it. Returns (bytes transferred, meta).
+    resp_meta = requests.get(f"{s1_url}/hint-meta", timeout=30)
+    resp_meta.raise_for_status()
+    hint_meta = resp_meta.json()
+    transferred = download_hint(s1_url, hint_meta)
+    # Memory-mapped in its stored uint32 form, writable so /hint-delta patches can be applied in place; only a
+    # non-power-of-two Q needs a derived copy, made once here.
+    hint_matrix = np.load(HINT_FILE, mmap_mode='r+')
+    app.config.update({'HINT_MATRIX': hint_matrix, 'HINT_OPERAND': shared_logic.prepare_mod_q_operand(hint_matrix),
+                       'HINT_EPOCH': hint_meta['epoch']})
+    return transferred, hint_meta
+
+def sync_hint(target_epoch):
+    # Brings the hint forward to the epoch Server1 answered at, using the sparse /hint-delta and falling back
+    # to a full download when Server1 no longer has the deltas. False if the hint cannot match that epoch.
+    s1_url = f"http://{S1_IP}:{S1_PORT}"
+    with HINT_LOCK:
+        current_epoch = app.config['HINT_EPOCH']
+        if target_epoch <= current_epoch: return target_epoch == current_epoch
+        resp = requests.get(f"{s1_url}/hint-delta", params={'since': current_epoch}, timeout=60)
+        if resp.status_code == 410:
+            print("S2: 增量不可用, 重新下载hint矩阵...")
+            load_hint(s1_url)
+            return app.config['HINT_EPOCH'] == target_epoch
+        resp.raise_for_status()
+        delta, meta = shared_logic.decode_array(resp.content)
+        columns = np.array(meta['columns'], dtype=np.int64)
+        hint_matrix, hint_operand = app.config['HINT_MATRIX'], app.config['HINT_OPERAND']
+        hint_matrix[:, columns] = shared_logic.add_mod_q(hint_matrix[:, columns], delta, out=np.empty_like(delta))
+        hint_matrix.flush()
+        if hint_operand is not hint_matrix:
+            hint_operand[:, columns] = shared_logic.prepare_mod_q_operand(hint_matrix[:, columns])
+        # The patched file now matches Server1's, so a later /setup can keep it.
+        with open(HINT_SHA_FILE, 'w') as f: f.write(meta['sha256'])
+        app.config['HINT_EPOCH'] = meta['to_epoch']
+        return meta['to_epoch'] == target_epoch
+
 @app.route('/setup', methods=['POST'])
 def setup_server2():
     s1_url = f"http://{S1_IP}:{S1_PORT}"; print("S2: 正在从Server1下载hint矩阵...")
     try:
         start_time = time.time()
-        with requests.get(f"{s1_url}/download/hint", stream=True, timeout=300) as r:
-            r.raise_for_status()
-            with open(HINT_FILE, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192): f.write(chunk)
-        hint_size_bytes = os.path.getsize(HINT_FILE); app.config['HINT_MATRIX'] = np.load(HINT_FILE)
+        with HINT_LOCK:
+            hint_size_bytes, hint_meta = load_hint(s1_url)
         setup_time = time.time() - start_time
         print(f"S2: Hint矩阵下载并加载完成")
-        return jsonify({"status": "s2 setup complete", "time": setup_time, "size_bytes": hint_size_bytes})
+        return jsonify({"status": "s2 setup complete", "time": setup_time, "size_bytes": hint_size_bytes,
+                        "hint_bytes": hint_meta['size'], "epoch": hint_meta['epoch']})
     except Exception as e: print(f"S2: 设置失败 - {e}"); return jsonify({"error": str(e)}), 500
 
+def wait_until_ready(transaction_id, timeout):
+    # None once s and ans are both in, else the error response: 503 when every waiter slot is taken and 408 when
+    # they are still missing after timeout (both polled again by the client), 400 if the client aborted.
+    keys = ('s', 'ans')
+    if TRANSACTION_STORE.wait_for(transaction_id, keys, 0, cancel_key='aborted'): return None
+    if READY_WAITERS.acquire(blocking=False):
+        try:
+            if TRANSACTION_STORE.wait_for(transaction_id, keys, timeout, cancel_key='aborted'): return None
+        finally:
+            READY_WAITERS.release()
+        status, body = 408, {"status": "not ready"}
+    else:
+        METRICS.inc('ready_waiters_rejected_total')
+        status, body = 503, {"status": "busy", "error": "too many requests waiting for transactions"}
+    if TRANSACTION_STORE.get(transaction_id, 'aborted'):
+        return jsonify({"error": "transaction aborted"}), 400
+    return jsonify(body), status, {'Retry-After': '0'} if status == 503 else {}
+
 @app.route('/receive-s', methods=['POST'])
 def receive_s():
-    data = request.json; transaction_id = data['transaction_id']
-    if transaction_id not in TRANSACTION_STORE: TRANSACTION_STORE[transaction_id] = {}
-    TRANSACTION_STORE[transaction_id]['s'] = np.array(data['s'], dtype=np.uint32)
+    with METRICS.stage('deserialize'):
+        s, meta = shared_logic.decode_vector_payload(request.mimetype, request.get_data(), 's')
+    TRANSACTION_STORE.put(meta['transaction_id'], 's', s)
     return jsonify({"status": "s received"})
 
 @app.route('/receive-ans', methods=['POST'])
 def receive_ans():
-    data = request.json; transaction_id = data['transaction_id']
-    if transaction_id not in TRANSACTION_STORE: TRANSACTION_STORE[transaction_id] = {}
-    TRANSACTION_STORE[transaction_id]['ans'] = np.array(data['ans'], dtype=np.uint32)
+    with METRICS.stage('deserialize'):
+        ans, meta = shared_logic.decode_vector_payload(request.mimetype, request.get_data(), 'ans')
+    TRANSACTION_STORE.update(meta['transaction_id'], {'ans': ans, 'ans_epoch': meta.get('epoch')})
     return jsonify({"status": "ans received"})
 
+@app.route('/receive-ans-batch', methods=['POST'])
+def receive_ans_batch():
+    with METRICS.stage('deserialize'):
+        ans_matrix, meta = shared_logic.decode_vector_payload(request.mimetype, request.get_data(), 'ans')
+    for transaction_id, ans in zip(meta['transaction_ids'], ans_matrix):
+        # Copied so each entry holds (and is charged for) only its own row, not the whole request body.
+        TRANSACTION_STORE.update(transaction_id, {'ans': ans.copy(), 'ans_epoch': meta.get('epoch')})
+    return jsonify({"status": "ans received", "count": len(meta['transaction_ids'])})
+
+@app.route('/abort-transaction/<transaction_id>', methods=['POST'])
+def abort_transaction(transaction_id):
+    # Lets a client whose qu Server1 refused release its pending /setup-verification right away.
+    TRANSACTION_STORE.put(transaction_id, 'aborted', True)
+    return jsonify({"status": "aborted"})
+
+@app.route('/wait-ready/<transaction_id>', methods=['GET'])
+def wait_ready(transaction_id):
+    timeout = min(float(request.args.get('timeout', READY_TIMEOUT)), READY_TIMEOUT)
+    return wait_until_ready(transaction_id, timeout) or jsonify({"status": "ready"})
+
 @app.route('/setup-verification', methods=['POST'])
 def setup_verification():
-    hint_matrix = app.config.get('HINT_MATRIX')
-    if hint_matrix is None: return jsonify({"error": "S2 Hint matrix not loaded"}), 500
+    if app.config.get('HINT_OPERAND') is None: return jsonify({"error": "S2 Hint matrix not loaded"}), 500
     data = request.json; transaction_id = data['transaction_id']; db_params = data['db_params']
-    if transaction_id not in TRANSACTION_STORE or 's' not in TRANSACTION_STORE[transaction_id] or 'ans' not in TRANSACTION_STORE[transaction_id]:
-        return jsonify({"error": "s or ans not received"}), 400
-    s = TRANSACTION_STORE[transaction_id]['s']; ans = TRANSACTION_STORE[transaction_id]['ans']
-    start_time_decrypt = time.time()
-    s_i64 = s.astype(np.int64); hint_matrix_i64 = hint_matrix.astype(np.int64); ans_i64 = ans.astype(np.int64)
-    s_hint = (s_i64 @ hint_matrix_i64) % shared_logic.LWE_Q
-    diff_mod_q = (ans_i64 - s_hint + shared_logic.LWE_Q) % shared_logic.LWE_Q
-    q = shared_logic.LWE_Q; half_q = q // 2; centered_diff = diff_mod_q.copy().astype(np.int64)
-    centered_diff[centered_diff > half_q] -= q
-    recovered_row_p = shared_logic.round_and_scale(centered_diff, shared_logic.SCALING_FACTOR)
-    decryption_time = time.time() - start_time_decrypt
-    start_time_bloom = time.time()
-    entry_vec_len = db_params['entry_vec_len']; max_cols_per_row = db_params['max_cols_per_row']
-    recovered_items = []
-    for i in range(max_cols_per_row):
-        item_vec = recovered_row_p[i*entry_vec_len:(i+1)*entry_vec_len]
-        if np.any(item_vec): recovered_items.append(shared_logic.int_array_to_bytes(item_vec))
-    bf = BloomFilter(capacity=len(recovered_items) or 1, error_rate=1e-9)
-    for item_bytes in recovered_items:
-        bf.add(shared_logic.oprf_server_eval_on_item(item_bytes, SK_OPRF))
-    bf_file_name = BF_FILE_NAME_TEMPLATE.format(transaction_id)
-    with open(bf_file_name, "wb") as f: bf.tofile(f)
-    TRANSACTION_STORE[transaction_id].update({
-        'decryption_time': decryption_time, 'bloom_gen_time': time.time() - start_time_bloom,
-        'recovered_items_hex': [item.hex() for item in recovered_items]
+    not_ready = wait_until_ready(transaction_id, min(float(data.get('wait_timeout', READY_TIMEOUT)), READY_TIMEOUT))
+    if not_ready: return not_ready
+    with TRANSACTION_STORE.lock(transaction_id):
+        # s and ans are only needed here; freeing them straight away keeps held state per finished query small.
+        s = TRANSACTION_STORE.pop(transaction_id, 's'); ans = TRANSACTION_STORE.pop(transaction_id, 'ans')
+        ans_epoch = TRANSACTION_STORE.pop(transaction_id, 'ans_epoch')
+        if s is None or ans is None: return jsonify({"error": "transaction already verified or evicted"}), 400
+        return verify_transaction(transaction_id, s, ans, ans_epoch, db_params, data)
+
+@functools.lru_cache(maxsize=OPRF_CACHE_ITEMS)
+def oprf_eval_item(item):
+    return shared_logic.oprf_server_eval_on_item(item, SK_OPRF)
+
+def verify_transaction(transaction_id, s, ans, ans_epoch, db_params, data):
+    with HINT_LOCK:
+        # A concurrent transaction answered at a newer epoch could otherwise patch the hint between this
+        # check and s·hint.
+        if ans_epoch is not None and ans_epoch != app.config['HINT_EPOCH'] and not sync_hint(ans_epoch):
+            return jsonify({"error": "answer and hint are from different database epochs; retry the query"}), 409
+        with METRICS.stage('decryption') as decryption:
+            s_hint = shared_logic.matvec_mod_q(s, app.config['HINT_OPERAND'])
+            diff_mod_q = shared_logic.sub_mod_q(ans, s_hint)
+            recovered_row_p = shared_logic.round_mod_q_to_p(diff_mod_q)
+    with METRICS.stage('oprf') as oprf:
+        entry_vec_len = db_params['entry_vec_len']; max_cols_per_row = db_params['max_cols_per_row']
+        item_slots = recovered_row_p[:max_cols_per_row * entry_vec_len].reshape(max_cols_per_row, entry_vec_len)
+        recovered_items = item_slots[item_slots.any(axis=1)]
+        oprf_values = shared_logic.oprf_server_eval_batch(recovered_items, SK_OPRF, eval_item=oprf_eval_item)
+    with METRICS.stage('filter_build') as filter_build:
+        filter_kind = data.get('filter_kind', MEMBERSHIP_FILTER_KIND)
+        fp_rate = float(data.get('fp_rate', MEMBERSHIP_FP_RATE))
+        membership_filter = shared_logic.build_membership_filter(oprf_values, filter_kind, fp_rate)
+    decryption_time, bloom_gen_time = decryption.elapsed, oprf.elapsed + filter_build.elapsed
+    METRICS.inc('verifications_total')
+    TRANSACTION_STORE.update(transaction_id, {
+        'decryption_time': decryption_time, 'bloom_gen_time': bloom_gen_time, 'membership_filter': membership_filter,
+        'recovered_items_hex': [item.tobytes().hex() for item in recovered_items]
     })
-    return jsonify({"status": "bloom filter created"})
+    return jsonify({"status": "bloom filter created",
+                    "s2_metrics": {"decryption_time": decryption_time, "bloom_gen_time": bloom_gen_time}})
 
 @app.route('/get-debug-info/<transaction_id>', methods=['GET'])
 def get_debug_info(transaction_id):
-    if transaction_id in TRANSACTION_STORE and 'recovered_items_hex' in TRANSACTION_STORE[transaction_id]:
-        return jsonify({"recovered_items_hex": TRANSACTION_STORE[transaction_id]['recovered_items_hex']})
+    recovered_items_hex = TRANSACTION_STORE.get(transaction_id, 'recovered_items_hex')
+    if recovered_items_hex is not None:
+        return jsonify({"recovered_items_hex": recovered_items_hex})
     return jsonify({"error": "No debug info found for this transaction"}), 404
 
 @app.route('/download-bf/<transaction_id>', methods=['GET'])
 def download_bf(transaction_id):
-    bf_file_name = BF_FILE_NAME_TEMPLATE.format(transaction_id)
-    try:
-        response = send_file(bf_file_name, as_attachment=True)
-        @response.call_on_close
-        def remove_file():
-            try: os.remove(bf_file_name)
-            except OSError: pass
-        return response
-    except FileNotFoundError: return jsonify({"error": "bf file not found"}), 404
+    # Served once from memory, like the file it replaces was deleted after download.
+    membership_filter = TRANSACTION_STORE.pop(transaction_id, 'membership_filter')
+    if membership_filter is None: return jsonify({"error": "membership filter not found"}), 404
+    return Response(membership_filter, mimetype=shared_logic.WIRE_CONTENT_TYPE)
 
 @app.route('/oprf-interactive-eval', methods=['POST'])
 def oprf_interactive_eval():
-    data = request.json; transaction_id = data['transaction_id']; blinded_element = data['blinded_element']
-    start_time = time.time()
-    evaluated_element = shared_logic.oprf_evaluate(blinded_element, SK_OPRF)
+    # {'blinded_element': x} or, for several items at once, {'blinded_elements': [x, ...]}.
+    data = request.json; transaction_id = data['transaction_id']
+    with METRICS.stage('oprf_interactive') as timer:
+        if 'blinded_elements' in data:
+            evaluated = {"evaluated_elements": shared_logic.oprf_evaluate_batch(data['blinded_elements'], SK_OPRF)}
+        else:
+            evaluated = {"evaluated_element": shared_logic.oprf_evaluate(data['blinded_element'], SK_OPRF)}
     s2_metrics = {
-        "decryption_time": TRANSACTION_STORE[transaction_id].get('decryption_time', 0),
-        "bloom_gen_time": TRANSACTION_STORE[transaction_id].get('bloom_gen_time', 0),
-        "oprf_eval_time": time.time() - start_time,
+        "decryption_time": TRANSACTION_STORE.get(transaction_id, 'decryption_time', 0),
+        "bloom_gen_time": TRANSACTION_STORE.get(transaction_id, 'bloom_gen_time', 0),
+        "oprf_eval_time": timer.elapsed,
     }
 
-    return jsonify({"status": "oprf evaluation complete", "evaluated_element": evaluated_element, "s2_metrics": s2_metrics})
+    return jsonify({"status": "oprf evaluation complete", **evaluated, "s2_metrics": s2_metrics})
+
+@app.route('/transaction-stats', methods=['GET'])
+def transaction_stats():
+    # server_threads lets a benchmark check that Server2 can serve all of its clients' requests at once.
+    return jsonify({**TRANSACTION_STORE.stats(), 'server_threads': SERVER_THREADS})
 
 if __name__ == '__main__':
     if not os.path.exists(DEBUG_DIR): os.makedirs(DEBUG_DIR)
     print(f"Server2 正在 http://0.0.0.0:{SERVER2_PORT} 上运行...")
     from waitress import serve
-    serve(app, host='0.0.0.0', port=SERVER2_PORT)
+    # setup-verification blocks a thread while it waits for s and ans, so keep spare threads for them.
+    serve(app, host='0.0.0.0', port=SERVER2_PORT, threads=SERVER_THREADS)
@@ -1,26 +1,195 @@
 # shared_logic.py (Final Corrected Version)
 import numpy as np
-import random
 import os
 import base64
 import hashlib
+import hmac
+import secrets
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.asymmetric import ec
 import math
+import json
+import struct
+import io
+import bisect
+import cProfile
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from pybloom_live import BloomFilter
 
 LWE_N =
 LWE_Q = 
 LWE_P =
 SCALING_FACTOR = LWE_Q // LWE_P
 
-PREFIX_BYTES = 2
+# Items are grouped into DB rows by the first prefix_bits bits of their hash. The width is chosen per database
+# by choose_prefix_bits and published in db_params; a prefix travels as its leading bytes with unused bits zeroed.
+MAX_PREFIX_BITS = 32
+# Non-zero entries of a query's noise vector e, one per DB row, so every layout needs at least this many rows.
+NOISE_HAMMING_WEIGHT = 64
 
-OPRF_GROUP_ORDER = 65521
-def generate_lwe_matrix_A(rows, cols):
-    return np.random.randint(0, LWE_Q, size=(rows, cols), dtype=np.uint32)
+WIRE_CONTENT_TYPE = 'application/octet-stream'
+WIRE_MAGIC = b'PIRW'
+WIRE_VERSION = 1
+# magic, version, dtype code, packed bit width (0 = raw), ndim, metadata length
+WIRE_HEADER = struct.Struct('<4sBBBBI')
+WIRE_DTYPES = {1: np.dtype('<u4'), 2: np.dtype('u1'), 3: np.dtype('<i8')}
+WIRE_DTYPE_CODES = {dt: code for code, dt in WIRE_DTYPES.items()}
+LWE_Q_BITS = max(1, (LWE_Q - 1).bit_length())
+# Columns of the right operand handled per step by the mod-Q kernels below.
+KERNEL_CHUNK_COLS = 256
+# A is never stored: it is the AES-256-CTR keystream under a public seed, expanded A_BLOCK_COLS columns at a time.
+LWE_SEED_BYTES = 32
+A_BLOCK_COLS = 1024
 
-def generate_noise_vector(dim, hamming_weight=64):
+OT_TAG_BYTES = 8
+# Per-transaction membership filter over the OPRF outputs of the recovered row.
+MEMBERSHIP_FILTER_KINDS = ('fingerprint', 'bloom')
+
+OPRF_CURVE = ec.SECP256R1()
+OPRF_CURVE_ORDER = 0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551
+# Domain separation tag of the RFC 9380 hash to curve, suite P256_XMD:SHA-256_SSWU_RO_.
+OPRF_HASH_DOMAIN = b'pir_oprf_v2-P256_XMD:SHA-256_SSWU_RO_'
+# P-256's field prime, curve coefficients (A = -3) and the SSWU constants of RFC 9380 section 8.2.
+P256_P = 0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff
+P256_A = P256_P - 3
+P256_B = 0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b
+P256_SSWU_Z = P256_P - 10
+P256_SQRT_MINUS_Z = pow(10, (P256_P + 1) // 4, P256_P)
+
+def _reduce_mod_q(x, q):
+    # x is uint64; for power-of-two q the mask is exact even after uint64 wrap-around.
+    if q & (q - 1) == 0: return x & np.uint64(q - 1)
+    return x % np.uint64(q)
+
+def split_limbs(left):
+    # 16-bit limbs of a uint32 operand stacked as [lo; hi], ready for the float64 GEMM in matmul_mod_q.
+    left = left.astype(np.uint32, copy=False)
+    return np.concatenate([(left & 0xFFFF).astype(np.float64), (left >> 16).astype(np.float64)])
+
+def _matmul_u8_mod_q(left, right, out, q, limbs, scratch):
+    # uint8 right operand (the database): exact float64 GEMM over 16-bit limbs of left, since
+    # n * 2^16 * 2^8 < 2^53. BLAS does the blocking; only one column chunk of right is widened at a time.
+    m, n = left.shape
+    assert n < 2 ** 29, "float64 limb product would lose exactness"
+    if limbs is None: limbs = split_limbs(left)
+    for i in range(0, right.shape[1], KERNEL_CHUNK_COLS):
+        end = min(i + KERNEL_CHUNK_COLS, right.shape[1])
+        if scratch is None or scratch.shape[0] != n or scratch.shape[1] < end - i:
+            scratch = np.empty((n, min(KERNEL_CHUNK_COLS, right.shape[1])), dtype=np.float64)
+        block = scratch[:, :end - i]
+        np.copyto(block, right[:, i:end])
+        partial = (limbs @ block).astype(np.uint64)
+        hi = partial[m:] if q & (q - 1) == 0 else partial[m:] % np.uint64(q)
+        out[:, i:end] = _reduce_mod_q((hi << np.uint64(16)) + partial[:m], q)
+    return out
+
+def _matmul_u32_mod_q(left, right, out, q):
+    left = left.astype(np.uint32, copy=False)
+    # A uint64 right operand (see prepare_mod_q_operand) is used as is, so the generic-Q path below never
+    # re-widens it per call.
+    if right.dtype != np.uint64: right = right.astype(np.uint32, copy=False)
+    if q & (q - 1) == 0 and q <= 2 ** 32:
+        # Wrapping uint32 arithmetic is already arithmetic mod 2^32, so the modulo is free.
+        np.matmul(left, right, out=out)
+        if q < 2 ** 32: out &= np.uint32(q - 1)
+        return out
+    # Generic Q: 16-bit limbs of left times uint32 right accumulate in uint64 without overflow
+    # for up to 2^15 inner terms; longer inner dimensions are reduced block by block.
+    lo = (left & 0xFFFF).astype(np.uint64)
+    hi = (left >> 16).astype(np.uint64)
+    q64 = np.uint64(q)
+    n = left.shape[1]
+    for i in range(0, right.shape[1], KERNEL_CHUNK_COLS):
+        end = min(i + KERNEL_CHUNK_COLS, right.shape[1])
+        acc = np.zeros((left.shape[0], end - i), dtype=np.uint64)
+        for j in range(0, n, 2 ** 15):
+            block = right[j:j + 2 ** 15, i:end].astype(np.uint64, copy=False)
+            acc += (((hi[:, j:j + 2 ** 15] @ block) % q64) << np.uint64(16)) % q64
+            acc += (lo[:, j:j + 2 ** 15] @ block) % q64
+            acc %= q64
+        out[:, i:end] = acc
+    return out
+
+def matmul_mod_q(left, right, out=None, q=LWE_Q, limbs=None, scratch=None):
+    # (m, n) uint32 @ (n, p) uint8/uint32 mod q, returned as (m, p) uint32 without int64 upcasts of the operands.
+    # limbs (from split_limbs) and scratch (an (n, c) float64 buffer) let callers reuse work across column blocks.
+    if out is None: out = np.empty((left.shape[0], right.shape[1]), dtype=np.uint32)
+    if right.dtype == np.uint8:
+        return _matmul_u8_mod_q(left, right, out, q, limbs, scratch)
+    return _matmul_u32_mod_q(left, right, out, q)
+
+def reference_matmul_mod_q(left, right, q=LWE_Q):
+    # The int64 path the servers used before the mod-Q kernels; exact Python ints where int64 could overflow.
+    # Kept as the oracle the kernels are tested and timed against.
+    if q <= 2 ** 32 and q & (q - 1) == 0:
+        return ((left.astype(np.int64) @ right.astype(np.int64)) % q).astype(np.uint32)
+    return ((left.astype(object) @ right.astype(object)) % q).astype(np.uint32)
+
+def prepare_mod_q_operand(mat, q=LWE_Q):
+    # The form of a long-lived uint32 right operand that matmul_mod_q uses without per-call conversion: the
+    # matrix itself when the modulus is a power of two, otherwise one uint64 copy made here, up front.
+    if q & (q - 1) == 0 and q <= 2 ** 32: return mat
+    return np.asarray(mat, dtype=np.uint64)
+
+def matvec_mod_q(vec, mat, q=LWE_Q):
+    return matmul_mod_q(vec.reshape(1, -1), mat, q=q)[0]
+
+def sub_mod_q(a, b, q=LWE_Q):
+    if q == 2 ** 32: return a.astype(np.uint32, copy=False) - b.astype(np.uint32, copy=False)
+    return ((a.astype(np.int64) - b.astype(np.int64)) % q).astype(np.uint32)
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''): digest.update(chunk)
+    return digest.hexdigest()
+
+def generate_lwe_seed():
+    return os.urandom(LWE_SEED_BYTES)
+
+def expand_lwe_matrix_A_T(seed, col_start, col_end, rows=LWE_N):
+    # Columns col_start..col_end of A, returned transposed as a contiguous (cols, rows) uint32 block.
+    # Column c is the c-th run of `rows` words of the keystream, so any range expands independently.
+    word_bytes = 4 if LWE_Q & (LWE_Q - 1) == 0 else 8
+    byte_start = col_start * rows * word_bytes
+    length = (col_end - col_start) * rows * word_bytes
+    offset = byte_start % 16
+    encryptor = Cipher(algorithms.AES(seed), modes.CTR((byte_start // 16).to_bytes(16, 'big'))).encryptor()
+    stream = encryptor.update(bytes(offset + length))
+    words = np.frombuffer(stream, dtype=f'<u{word_bytes}', count=length // word_bytes, offset=offset)
+    if word_bytes == 8: words = (words % np.uint64(LWE_Q)).astype(np.uint32)
+    elif LWE_Q < 2 ** 32: words = words & np.uint32(LWE_Q - 1)
+    return words.reshape(col_end - col_start, rows)
+
+def iter_lwe_matrix_A_blocks(seed, num_cols, block_cols=A_BLOCK_COLS):
+    for col_start in range(0, num_cols, block_cols):
+        col_end = min(col_start + block_cols, num_cols)
+        yield col_start, col_end, expand_lwe_matrix_A_T(seed, col_start, col_end)
+
+def seeded_vec_times_A(seed, vec, num_cols):
+    # vec @ A mod Q, streaming A block by block so the full matrix is never materialized.
+    out = np.empty(num_cols, dtype=np.uint32)
+    for col_start, col_end, A_T_block in iter_lwe_matrix_A_blocks(seed, num_cols):
+        out[col_start:col_end] = matmul_mod_q(A_T_block, vec.reshape(-1, 1))[:, 0]
+    return out
+
+def add_mod_q(a, b, out=None, q=LWE_Q):
+    if q & (q - 1) == 0 and q <= 2 ** 32:
+        out = np.add(a, b, out=out)
+        if q < 2 ** 32: out &= np.uint32(q - 1)
+        return out
+    return np.mod(a.astype(np.uint64) + b, q, out=out, casting='unsafe')
+
+def generate_noise_vector(dim, hamming_weight=NOISE_HAMMING_WEIGHT):
+    # choose_prefix_bits keeps layouts at NOISE_HAMMING_WEIGHT rows or more; only a database with fewer
+    # distinct items than that gets a lighter noise vector.
+    hamming_weight = min(hamming_weight, dim)
     noise = np.zeros(dim, dtype=np.int64)
     indices = np.random.choice(dim, size=hamming_weight, replace=False)
     values = np.random.randint(-2, 3, size=hamming_weight)
@@ -29,15 +198,101 @@ def generate_noise_vector(dim, hamming_weight=64):
     return noise
 def round_and_scale(vector, delta):
     return np.round(vector * (1/delta)).astype(np.uint8)
+def round_mod_q_to_p(diff_mod_q, delta=SCALING_FACTOR, p=LWE_P):
+    # round_and_scale of the centered difference, without building a signed copy: the nearest multiple of
+    # delta, reduced mod p, so values just below Q (small negative noise) land on 0.
+    rounded = (diff_mod_q.astype(np.uint64) + np.uint64(delta // 2)) // np.uint64(delta)
+    return (rounded % np.uint64(p)).astype(np.uint8)
+def row_keys(hash_array):
+    # First 64 bits of each hash as a big-endian integer (zero-padded), a cheap stand-in key for whole rows.
+    keys = np.zeros((len(hash_array), 8), dtype=np.uint8)
+    keys[:, :min(8, hash_array.shape[1])] = hash_array[:, :8]
+    return keys.view('>u8').reshape(-1).astype(np.uint64)
+def distinct_rows(hash_array):
+    # hash_array without repeated rows, first occurrences kept in order. Rows are sorted on row_keys and only
+    # those whose keys collide are compared in full.
+    keys = row_keys(hash_array)
+    order = np.argsort(keys)
+    same = np.flatnonzero(keys[order][1:] == keys[order][:-1])
+    if not len(same): return hash_array
+    candidates = np.unique(np.concatenate([order[same], order[same + 1]]))
+    rows = np.ascontiguousarray(hash_array[candidates]).view(np.dtype((np.void, hash_array.shape[1]))).reshape(-1)
+    first = np.unique(rows, return_index=True)[1]
+    return np.delete(hash_array, np.setdiff1d(candidates, candidates[first]), axis=0)
 def generate_hash_database(num_entries, hash_len_bytes=32):
-    db_hashes = set()
-    while len(db_hashes) < num_entries:
-        random_data = os.urandom(32)
-        h = hashlib.sha256(random_data).digest()
-        db_hashes.add(h[:hash_len_bytes])
-    return list(db_hashes)
-def get_prefix_from_hash(item_hash):
-    return item_hash[:PREFIX_BYTES]
+    # num_entries distinct uniformly random hashes as an (N, hash_len_bytes) uint8 array.
+    hashes = np.zeros((0, hash_len_bytes), dtype=np.uint8)
+    while len(hashes) < num_entries:
+        missing = num_entries - len(hashes)
+        fresh = np.frombuffer(os.urandom(missing * hash_len_bytes), dtype=np.uint8).reshape(missing, hash_len_bytes)
+        hashes = distinct_rows(np.concatenate([hashes, fresh]) if len(hashes) else fresh)
+    return hashes
+def save_hash_file(path, hash_array):
+    # Hash lists are (N, hash_len) uint8 .npy files: fixed-width records after a short header, so they can be
+    # memory-mapped or read by byte range. Written beside path and renamed into place.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f: np.save(f, np.asarray(hash_array, dtype=np.uint8))
+    os.replace(tmp_path, path)
+def load_hash_file(path):
+    # Memory-maps a .npy hash list; a legacy JSON list of hex strings is parsed instead.
+    if not path.endswith('.json'):
+        hashes = np.load(path, mmap_mode='r')
+        if hashes.ndim != 2 or hashes.dtype != np.uint8: raise ValueError(f"{path} is not an (N, hash_len) uint8 array")
+        return hashes
+    with open(path) as f: hex_items = json.load(f)
+    return np.frombuffer(bytes.fromhex(''.join(hex_items)), dtype=np.uint8).reshape(len(hex_items), -1)
+def read_hash_file_header(buf):
+    # (num_items, hash_len) and the byte offset of the first record, from the first bytes of a hash file.
+    f = io.BytesIO(buf)
+    version = np.lib.format.read_magic(f)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    shape, _, dtype = read_header(f)
+    if len(shape) != 2 or dtype != np.uint8: raise ValueError("not an (N, hash_len) uint8 hash file")
+    return shape, f.tell()
+def prefix_nbytes(prefix_bits):
+    return (prefix_bits + 7) // 8
+def get_prefix_from_hash(item_hash, prefix_bits):
+    prefix = bytearray(item_hash[:prefix_nbytes(prefix_bits)])
+    prefix[-1] &= (0xff << (8 * len(prefix) - prefix_bits)) & 0xff
+    return bytes(prefix)
+def hashes_to_array(db_hashes):
+    if isinstance(db_hashes, np.ndarray): return db_hashes
+    if not db_hashes: return np.zeros((0, 0), dtype=np.uint8)
+    return np.frombuffer(b''.join(db_hashes), dtype=np.uint8).reshape(len(db_hashes), -1)
+def leading_words(hash_array):
+    # First 32 bits of each hash as a big-endian integer; hashes shorter than 4 bytes are zero-padded.
+    words = np.zeros((len(hash_array), 4), dtype=np.uint8)
+    words[:, :min(4, hash_array.shape[1])] = hash_array[:, :4]
+    return words.view('>u4').reshape(-1).astype(np.uint32)
+def prefix_values(hash_array, prefix_bits):
+    # Integer value of each hash's prefix bytes, i.e. of get_prefix_from_hash(h, prefix_bits) read big-endian.
+    unused_bits = 8 * prefix_nbytes(prefix_bits) - prefix_bits
+    return (leading_words(hash_array) >> np.uint32(32 - prefix_bits)) << np.uint32(unused_bits)
+def choose_prefix_bits(words, entry_len):
+    # Picks the prefix width for the layout of N items with the given leading words. Rows cost client and
+    # hint-side work in proportion to their number R, row width C = max bucket * entry_len costs Server2 and
+    # the answer in proportion to C, and Server1 scans R * C. Widths near log2(sqrt(N * entry_len)), where
+    # R and C balance, are scored on their actual bucket sizes by R * C / sqrt(N * entry_len) + R + C, so
+    # the Poisson tail's padding is weighed against a lopsided shape. Widths giving fewer than
+    # NOISE_HAMMING_WEIGHT rows are skipped, widening past the window if need be, since queries need that
+    # many rows to place their noise.
+    num_entries = len(words)
+    if num_entries < 2: return 1
+    scale = np.sqrt(num_entries * entry_len)
+    target = int(round(np.log2(scale)))
+    max_bits = min(MAX_PREFIX_BITS, 8 * entry_len)
+    sorted_words = np.sort(words)
+    min_rows = NOISE_HAMMING_WEIGHT if num_entries >= NOISE_HAMMING_WEIGHT else 1
+    best_bits, best_cost = None, float('inf')
+    for bits in range(max(1, target - 3), max_bits + 1):
+        if bits > target + 3 and best_bits is not None: break
+        row_ids = sorted_words >> np.uint32(32 - bits)
+        row_starts = np.concatenate(([0], np.flatnonzero(np.diff(row_ids)) + 1, [num_entries]))
+        num_rows, max_count = len(row_starts) - 1, int(np.diff(row_starts).max())
+        if num_rows < min_rows: continue
+        cost = num_rows * max_count * entry_len / scale + num_rows + max_count * entry_len
+        if cost < best_cost: best_bits, best_cost = bits, cost
+    return best_bits if best_bits is not None else max_bits
 def bytes_to_int_array(b):
     return np.frombuffer(b, dtype=np.uint8)
 def int_array_to_bytes(arr):
@@ -54,23 +309,385 @@ def decrypt_index(key, token):
         return int.from_bytes(f.decrypt(token.encode('utf-8')), 'big')
     except Exception:    return None
 
-def hash_to_group_element(item_hash):
-    return int.from_bytes(item_hash, 'big') % OPRF_GROUP_ORDER
+def get_lookup_tag(key):
+    return hmac.new(base64.urlsafe_b64decode(key), b'ot_lookup_tag_v1', hashlib.sha256).digest()[:OT_TAG_BYTES]
+
+def build_ot_table(prefix_list, encrypted_list, epoch):
+    # One fixed-width record per prefix: lookup tag followed by its Fernet token, sorted by tag.
+    records = sorted(get_lookup_tag(get_key_from_prefix(bytes.fromhex(prefix_hex))) + token.encode('utf-8')
+                     for prefix_hex, token in zip(prefix_list, encrypted_list))
+    table = np.frombuffer(b''.join(records), dtype=np.uint8).reshape(len(records), -1)
+    return encode_array(table, {'epoch': epoch, 'tag_bytes': OT_TAG_BYTES})
+
+def load_ot_table(buf):
+    table, meta = decode_array(buf)
+    tags = np.ascontiguousarray(table[:, :OT_TAG_BYTES]).view('>u8').reshape(-1)
+    return tags, table, meta
+
+def lookup_ot_index(tags, table, key):
+    tag = int.from_bytes(get_lookup_tag(key), 'big')
+    pos = int(np.searchsorted(tags, tag))
+    while pos < len(tags) and tags[pos] == tag:
+        index = decrypt_index(key, table[pos, OT_TAG_BYTES:].tobytes().decode('utf-8'))
+        if index is not None: return index
+        pos += 1
+    return None
+
+# OPRF over P-256: F(k, x) = X(k * H(x)), the x-coordinate of k times x hashed onto the curve. Every scalar
+# multiplication is an ECDH exchange in OpenSSL's constant-time P-256 code. Elements travel as 32-byte
+# x-coordinates, since X(k * P) = X(k * -P) lets either point with a given x stand in for the other.
+# H is RFC 9380's P256_XMD:SHA-256_SSWU_RO_: the same straight-line sequence of field operations for every
+# input, with selections done arithmetically, square roots as fixed-exponent powers and the one inversion
+# masked. It is written with Python integers, whose arithmetic CPython does not promise to run in constant
+# time, so it removes the input-dependent attempt count of try-and-increment rather than being a hardened
+# implementation.
+def _masked_inverse(x, modulus):
+    # 1/x taken of x * m for a fresh random m and multiplied back by m, so the variable-time inversion only
+    # ever sees a uniformly random value unrelated to x.
+    mask = secrets.randbelow(modulus - 1) + 1
+    return pow(x * mask % modulus, -1, modulus) * mask % modulus
+
+def _cmov(a, b, c):
+    # b if c else a, for c in {0, 1}, without a branch.
+    return (a * (1 - c) + b * c) % P256_P
+
+def _expand_message_xmd(msg, dst, len_in_bytes):
+    dst_prime = dst + bytes([len(dst)])
+    b_0 = hashlib.sha256(bytes(64) + msg + len_in_bytes.to_bytes(2, 'big') + b'\x00' + dst_prime).digest()
+    blocks = [hashlib.sha256(b_0 + b'\x01' + dst_prime).digest()]
+    for i in range(2, -(-len_in_bytes // 32) + 1):
+        chained = bytes(x ^ y for x, y in zip(b_0, blocks[-1]))
+        blocks.append(hashlib.sha256(chained + bytes([i]) + dst_prime).digest())
+    return b''.join(blocks)[:len_in_bytes]
+
+def _sqrt_ratio_3mod4(u, v):
+    # (1, sqrt(u / v)) if u / v is a square, else (0, sqrt(Z * u / v)).
+    p = P256_P
+    tv1 = v * v % p
+    tv2 = u * v % p
+    y1 = pow(tv1 * tv2 % p, (p - 3) // 4, p) * tv2 % p
+    is_square = int(y1 * y1 % p * v % p == u)
+    return is_square, _cmov(y1 * P256_SQRT_MINUS_Z % p, y1, is_square)
+
+def _map_to_curve_sswu(u):
+    # Simplified SWU map (RFC 9380 appendix F.2) to projective (X : Y : Z), leaving out the division by Z.
+    p, a, b, z = P256_P, P256_A, P256_B, P256_SSWU_Z
+    tv1 = z * (u * u % p) % p
+    tv2 = (tv1 * tv1 + tv1) % p
+    tv3 = b * (tv2 + 1) % p
+    tv4 = a * _cmov(z, p - tv2, int(tv2 != 0)) % p
+    tv6 = tv4 * tv4 % p
+    gx_num = (tv3 * tv3 + a * tv6) % p * tv3 % p
+    tv6 = tv6 * tv4 % p
+    gx_num = (gx_num + b * tv6) % p
+    is_square, y1 = _sqrt_ratio_3mod4(gx_num, tv6)
+    x_num = _cmov(tv1 * tv3 % p, tv3, is_square)
+    y = _cmov(tv1 * u % p * y1 % p, y1, is_square)
+    y = _cmov(p - y, y, int(u % 2 == y % 2))
+    return x_num, y * tv4 % p, tv4
+
+def _add_points(p1, p2):
+    # Complete projective addition for a = -3 (Renes, Costello and Batina 2016, algorithm 4): no special
+    # cases for doubling or the point at infinity.
+    p, b = P256_P, P256_B
+    x1, y1, z1 = p1
+    x2, y2, z2 = p2
+    t0, t1, t2 = x1 * x2 % p, y1 * y2 % p, z1 * z2 % p
+    t3 = ((x1 + y1) * (x2 + y2) - t0 - t1) % p
+    t4 = ((y1 + z1) * (y2 + z2) - t1 - t2) % p
+    y3 = ((x1 + z1) * (x2 + z2) - t0 - t2) % p
+    x3 = (y3 - b * t2) % p
+    x3 = 3 * x3 % p
+    z3 = (t1 - x3) % p
+    x3 = (t1 + x3) % p
+    y3 = (b * y3 - 3 * t2 - t0) % p
+    y3 = 3 * y3 % p
+    t0 = (3 * t0 - 3 * t2) % p
+    x3, y3, z3 = (x3 * t3 - t4 * y3) % p, (x3 * z3 + t0 * y3) % p, (t4 * z3 + t3 * t0) % p
+    return x3, y3, z3
+
+def hash_to_group_element(item_hash, dst=OPRF_HASH_DOMAIN):
+    uniform = _expand_message_xmd(bytes(item_hash), dst, 96)
+    u0, u1 = (int.from_bytes(uniform[i:i + 48], 'big') % P256_P for i in (0, 48))
+    x, y, z = _add_points(_map_to_curve_sswu(u0), _map_to_curve_sswu(u1))
+    # P-256 has cofactor 1, so the sum is already in the group; Z = 0 (the identity) has negligible odds.
+    z_inv = _masked_inverse(z, P256_P)
+    return ec.EllipticCurvePublicKey.from_encoded_point(
+        OPRF_CURVE, b'\x04' + (x * z_inv % P256_P).to_bytes(32, 'big') + (y * z_inv % P256_P).to_bytes(32, 'big'))
+def oprf_point(x_coordinate):
+    return ec.EllipticCurvePublicKey.from_encoded_point(OPRF_CURVE, b'\x02' + bytes.fromhex(x_coordinate))
+def oprf_generate_key():
+    return ec.generate_private_key(OPRF_CURVE)
 def oprf_blind(element):
-    exponent_modulus = OPRF_GROUP_ORDER - 1
-    while True:
-        blinding_factor = random.randint(2, exponent_modulus - 1)
-        if math.gcd(blinding_factor, exponent_modulus) == 1:    
-            break
-    blinded_element = pow(element, blinding_factor, OPRF_GROUP_ORDER)
-    return blinded_element, blinding_factor
+    blinding_key = ec.generate_private_key(OPRF_CURVE)
+    blinded_element = blinding_key.exchange(ec.ECDH(), element)
+    return blinded_element.hex(), blinding_key.private_numbers().private_value
 def oprf_evaluate(blinded_element, sk_oprf):
-    return pow(blinded_element, sk_oprf, OPRF_GROUP_ORDER)
+    return sk_oprf.exchange(ec.ECDH(), oprf_point(blinded_element)).hex()
 def oprf_unblind(evaluated_element, blinding_factor):
-    exponent_modulus = OPRF_GROUP_ORDER - 1
-    inverse_blinding = pow(blinding_factor, -1, exponent_modulus)
-    return pow(evaluated_element, inverse_blinding, OPRF_GROUP_ORDER)
+    inverse_blinding = ec.derive_private_key(_masked_inverse(blinding_factor, OPRF_CURVE_ORDER), OPRF_CURVE)
+    return inverse_blinding.exchange(ec.ECDH(), oprf_point(evaluated_element))
 
 def oprf_server_eval_on_item(item, sk_oprf):
-    element = hash_to_group_element(item)
-    return pow(element, sk_oprf, OPRF_GROUP_ORDER)
+    return sk_oprf.exchange(ec.ECDH(), hash_to_group_element(item))
+
+def oprf_blind_batch(items):
+    # Client side: blinds every item; returns the blinded elements and the factors oprf_unblind_batch needs.
+    blinded = [oprf_blind(hash_to_group_element(item)) for item in items]
+    return [b for b, _ in blinded], [r for _, r in blinded]
+
+def oprf_evaluate_batch(blinded_elements, sk_oprf):
+    return [oprf_evaluate(b, sk_oprf) for b in blinded_elements]
+
+def oprf_unblind_batch(evaluated_elements, blinding_factors):
+    return [oprf_unblind(e, r) for e, r in zip(evaluated_elements, blinding_factors)]
+
+def oprf_server_eval_batch(items, sk_oprf, eval_item=None):
+    # F(sk_oprf, item) as bytes for each row of an (n, item_len) uint8 array. eval_item(item_bytes), e.g. a
+    # cached wrapper around oprf_server_eval_on_item, replaces the direct evaluation; repeated items are
+    # evaluated once.
+    eval_item = eval_item or (lambda item: oprf_server_eval_on_item(item, sk_oprf))
+    item_bytes = [item.tobytes() for item in np.asarray(items, dtype=np.uint8)]
+    values = {item: eval_item(item) for item in dict.fromkeys(item_bytes)}
+    return [values[item] for item in item_bytes]
+
+
+def pack_bits(values, bits):
+    v = np.ascontiguousarray(values, dtype='<u4').reshape(-1)
+    planes = np.unpackbits(v.view(np.uint8).reshape(-1, 4), axis=1, bitorder='little')[:, :bits]
+    return np.packbits(planes, bitorder='little').tobytes()
+
+def unpack_bits(buf, bits, count):
+    planes = np.unpackbits(np.frombuffer(buf, dtype=np.uint8), count=count * bits, bitorder='little')
+    full = np.zeros((count, 32), dtype=np.uint8)
+    full[:, :bits] = planes.reshape(count, bits)
+    return np.packbits(full, axis=1, bitorder='little').view('<u4').reshape(-1)
+
+def encode_array(arr, meta=None, dtype=None, bits=None):
+    # Binary frame: fixed header, shape, JSON metadata (transaction_id etc.), padding to 8 bytes, payload.
+    arr = np.ascontiguousarray(arr, dtype=np.dtype(dtype or arr.dtype).newbyteorder('<'))
+    if arr.dtype not in WIRE_DTYPE_CODES:
+        raise ValueError(f"unsupported wire dtype: {arr.dtype}")
+    if bits is not None and (arr.dtype != np.dtype('<u4') or bits >= 32):
+        bits = None
+    meta_bytes = json.dumps(meta or {}, separators=(',', ':')).encode('utf-8')
+    header = WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, WIRE_DTYPE_CODES[arr.dtype], bits or 0, arr.ndim,
+                              len(meta_bytes))
+    header += struct.pack(f'<{arr.ndim}I', *arr.shape) + meta_bytes
+    header += b'\0' * (-len(header) % 8)
+    payload = pack_bits(arr, bits) if bits else arr.tobytes()
+    return header + payload
+
+def decode_array(buf):
+    # Returns a read-only view into buf for raw frames; only bit-packed frames are copied.
+    magic, version, dtype_code, bits, ndim, meta_len = WIRE_HEADER.unpack_from(buf, 0)
+    if magic != WIRE_MAGIC or version != WIRE_VERSION:
+        raise ValueError("not a PIR wire frame")
+    offset = WIRE_HEADER.size
+    shape = struct.unpack_from(f'<{ndim}I', buf, offset)
+    offset += 4 * ndim
+    meta = json.loads(bytes(buf[offset:offset + meta_len]) or b'{}')
+    offset += meta_len
+    offset += -offset % 8
+    dtype = WIRE_DTYPES[dtype_code]
+    count = int(np.prod(shape, dtype=np.int64))
+    if bits:
+        arr = unpack_bits(memoryview(buf)[offset:], bits, count)
+    else:
+        arr = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+    return arr.reshape(shape), meta
+
+def decode_vector_payload(mimetype, body, field, dtype=np.uint32):
+    # Accepts both the binary frame and the legacy JSON body {field: [...], 'transaction_id': ...}.
+    if mimetype == WIRE_CONTENT_TYPE:
+        return decode_array(body)
+    data = json.loads(body)
+    vec = np.array(data.pop(field), dtype=dtype)
+    return vec, data
+
+
+def oprf_output_bytes(value):
+    if isinstance(value, bytes): return value
+    value = int(value)
+    return value.to_bytes((value.bit_length() + 7) // 8 or 1, 'big')
+
+def membership_fingerprint(value, fp_bytes):
+    return hashlib.sha256(b'pir_membership_v1' + oprf_output_bytes(value)).digest()[:fp_bytes]
+
+def fingerprint_bytes_for(num_items, fp_rate):
+    # A lookup collides with one of num_items stored fingerprints with probability about num_items / 2^bits.
+    return max(1, math.ceil((math.log2(max(num_items, 1)) + math.log2(1 / fp_rate)) / 8))
+
+def build_membership_filter(values, kind='fingerprint', fp_rate=1e-9):
+    # Returns a wire frame (see encode_array). 'fingerprint' is the sorted (n, fp_bytes) array of truncated
+    # hashes of the values; 'bloom' is a serialized pybloom_live filter. meta['bloom_bytes'] is the size the
+    # Bloom filter would have had, so callers can report what the fingerprint form saves.
+    if kind not in MEMBERSHIP_FILTER_KINDS: raise ValueError(f"unknown membership filter kind: {kind}")
+    bloom = BloomFilter(capacity=len(values) or 1, error_rate=fp_rate)
+    bloom_bytes = struct.calcsize(BloomFilter.FILE_FMT) + (bloom.num_bits + 7) // 8
+    if kind == 'bloom':
+        for value in values: bloom.add(value)
+        buf = io.BytesIO()
+        bloom.tofile(buf)
+        return encode_array(np.frombuffer(buf.getvalue(), dtype=np.uint8),
+                            {'kind': kind, 'bloom_bytes': bloom_bytes}, dtype=np.uint8)
+    fp_bytes = fingerprint_bytes_for(len(values), fp_rate)
+    fingerprints = sorted(membership_fingerprint(value, fp_bytes) for value in values)
+    table = np.frombuffer(b''.join(fingerprints), dtype=np.uint8).reshape(len(fingerprints), fp_bytes)
+    return encode_array(table, {'kind': kind, 'fp_bytes': fp_bytes, 'bloom_bytes': bloom_bytes}, dtype=np.uint8)
+
+def membership_filter_contains(buf, value):
+    table, meta = decode_array(buf)
+    if meta['kind'] == 'bloom':
+        return value in BloomFilter.fromfile(io.BytesIO(table.tobytes()))
+    fingerprint = np.frombuffer(membership_fingerprint(value, meta['fp_bytes']), dtype=np.uint8)
+    return bool(np.any(np.all(table == fingerprint, axis=1)))
+
+
+# Histogram bounds for stage and request latencies (seconds) and for payload sizes (bytes).
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = tuple(float(4 ** k) for k in range(3, 16))
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class StageTimer:
+    __slots__ = ('elapsed',)
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+class MetricsRegistry:
+    # Histograms and counters for one server, rendered in the Prometheus text format under `namespace`.
+    # Recording is a dict lookup, a bisect and two additions under one lock, cheap enough to leave on.
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauge_sources = []
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None: histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def register_gauges(self, source):
+        # source() returns {name: value}; it is called on every render.
+        self._gauge_sources.append(source)
+
+    @contextmanager
+    def stage(self, stage):
+        # Times the block on the monotonic clock into stage_seconds{stage=...}; timer.elapsed holds the result.
+        timer = StageTimer()
+        start = time.perf_counter()
+        try:
+            yield timer
+        finally:
+            timer.elapsed = time.perf_counter() - start
+            self.observe('stage_seconds', timer.elapsed, stage=stage)
+
+    def render(self):
+        def series(name, labels, extra=()):
+            pairs = ','.join(f'{k}="{v}"' for k, v in (*labels, *extra))
+            return f"{self.namespace}_{name}{{{pairs}}}" if pairs else f"{self.namespace}_{name}"
+        with self._lock:
+            histograms = [(key, list(h.counts), h.sum, h.bounds) for key, h in self._histograms.items()]
+            counters = list(self._counters.items())
+        lines, typed = [], set()
+        for (name, labels), counts, total, bounds in sorted(histograms):
+            if name not in typed: lines.append(f"# TYPE {self.namespace}_{name} histogram"); typed.add(name)
+            cumulative = 0
+            for bound, count in zip((*bounds, '+Inf'), counts):
+                cumulative += count
+                lines.append(f"{series(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{series(name + '_sum', labels)} {total}")
+            lines.append(f"{series(name + '_count', labels)} {cumulative}")
+        for (name, labels), value in sorted(counters):
+            if name not in typed: lines.append(f"# TYPE {self.namespace}_{name} counter"); typed.add(name)
+            lines.append(f"{series(name, labels)} {value}")
+        for source in self._gauge_sources:
+            for name, value in source().items():
+                lines += [f"# TYPE {self.namespace}_{name} gauge", f"{series(name, ())} {value}"]
+        return '\n'.join(lines) + '\n'
+
+def instrument_app(app, registry):
+    # Records latency and bytes in/out per endpoint for every request and serves GET /metrics. Profiling is
+    # opt-in per endpoint: POST /profile {"endpoint": name, "enabled": true} runs that endpoint's requests
+    # under cProfile, one request at a time, and GET /profile/<name> returns the accumulated stats.
+    from flask import request, g, Response, jsonify
+    profiles = {}
+    # profiles_lock guards the dict; run_lock is held by the one request being profiled, and is taken
+    # without blocking so other requests to the endpoint just run unprofiled.
+    profiles_lock = threading.Lock()
+    run_lock = threading.Lock()
+    unprofiled = {'set_profiling', 'get_profile'}
+
+    @app.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+        if request.endpoint in profiles and run_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.endpoint or 'unknown'
+        registry.observe('request_seconds', time.perf_counter() - g.metrics_start, endpoint=endpoint)
+        registry.observe('request_bytes', request.content_length or 0, SIZE_BUCKETS, endpoint=endpoint)
+        registry.observe('response_bytes', response.content_length or 0, SIZE_BUCKETS, endpoint=endpoint)
+        registry.inc('responses_total', endpoint=endpoint, status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        profiler = g.pop('profiler', None)
+        if profiler is None: return
+        profiler.disable()
+        with profiles_lock:
+            if request.endpoint in profiles:
+                stats = profiles[request.endpoint]
+                if stats is None: profiles[request.endpoint] = pstats.Stats(profiler)
+                else: stats.add(profiler)
+        run_lock.release()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/profile', methods=['POST'])
+    def set_profiling():
+        data = request.json or {}
+        endpoint = data.get('endpoint')
+        if endpoint not in app.view_functions: return jsonify({"error": f"unknown endpoint: {endpoint}"}), 400
+        if endpoint in unprofiled: return jsonify({"error": f"{endpoint} cannot be profiled"}), 400
+        with profiles_lock:
+            if data.get('enabled', True): profiles.setdefault(endpoint, None)
+            else: profiles.pop(endpoint, None)
+        return jsonify({"profiling": sorted(profiles)})
+
+    @app.route('/profile/<endpoint>', methods=['GET'])
+    def get_profile(endpoint):
+        with profiles_lock:
+            stats = profiles.get(endpoint)
+            if stats is None: return jsonify({"error": "no profile recorded for this endpoint"}), 404
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats(request.args.get('sort', 'cumulative')).print_stats(int(request.args.get('limit', 40)))
+        return Response(out.getvalue(), mimetype='text/plain')
@@ -0,0 +1,24 @@
+# test_kernels.py (The mod-Q kernels against the int64 / exact-integer reference they replaced)
+import numpy as np
+import pytest
+
+import shared_logic
+
+MODULI = [2 ** 32, 2 ** 20, 4294967291, 65521]
+SHAPES = [(1, 1, 1), (1, 1024, 300), (7, 1000, 513), (3, 70000, 40)]
+
+
+@pytest.mark.parametrize('q', MODULI)
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('right_dtype', [np.uint8, np.uint32])
+def test_matmul_mod_q_matches_reference(q, shape, right_dtype):
+    m, n, p = shape
+    if right_dtype == np.uint32 and n > 2 ** 12 and q & (q - 1):
+        pytest.skip("exact-integer reference too slow at this size")
+    rng = np.random.default_rng([q % 2 ** 32, m, n, p])
+    left = rng.integers(0, q, size=(m, n), dtype=np.uint64).astype(np.uint32)
+    high = 256 if right_dtype == np.uint8 else q
+    right = rng.integers(0, high, size=(n, p), dtype=np.uint64).astype(right_dtype)
+    expected = shared_logic.reference_matmul_mod_q(left, right, q)
+    assert np.array_equal(shared_logic.matmul_mod_q(left, right, q=q), expected)
+
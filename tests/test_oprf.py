@@ -0,0 +1,30 @@
+# test_oprf.py (Hash to curve against RFC 9380's vectors, and the blinded OPRF against direct evaluation)
+import os
+
+import pytest
+
+import shared_logic
+
+# RFC 9380 appendix J.1.1, suite P256_XMD:SHA-256_SSWU_RO_.
+RFC9380_DST = b'QUUX-V01-CS02-with-P256_XMD:SHA-256_SSWU_RO_'
+RFC9380_VECTORS = [
+    (b'', 0x2c15230b26dbc6fc9a37051158c95b79656e17a1a920b11394ca91c44247d3e4,
+     0x8a7a74985cc5c776cdfe4b1f19884970453912e9d31528c060be9ab5c43e8415),
+    (b'abc', 0x0bb8b87485551aa43ed54f009230450b492fead5f1cc91658775dac4a3388a0f,
+     0x5c41b3d0731a27a7b14bc0bf0ccded2d8751f83493404c84a88e71ffd424212e),
+]
+
+
+@pytest.mark.parametrize('msg, x, y', RFC9380_VECTORS)
+def test_hash_to_group_element_matches_rfc9380(msg, x, y):
+    numbers = shared_logic.hash_to_group_element(msg, dst=RFC9380_DST).public_numbers()
+    assert (numbers.x, numbers.y) == (x, y)
+
+
+def test_blinded_evaluation_matches_server_evaluation():
+    sk_oprf = shared_logic.oprf_generate_key()
+    items = [os.urandom(32) for _ in range(8)]
+    blinded, factors = shared_logic.oprf_blind_batch(items)
+    unblinded = shared_logic.oprf_unblind_batch(shared_logic.oprf_evaluate_batch(blinded, sk_oprf), factors)
+    assert unblinded == [shared_logic.oprf_server_eval_on_item(item, sk_oprf) for item in items]
+    assert len(set(unblinded)) == len(items)
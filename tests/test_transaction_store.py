@@ -0,0 +1,77 @@
+# test_transaction_store.py (Server2's per-transaction state stays within its byte budget and TTL)
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from transaction_store import TransactionStore, ENTRY_OVERHEAD_BYTES
+
+TTL = 2.0
+MAX_BYTES = 256 * 2 ** 10
+S = np.zeros(64, dtype=np.uint32)
+ANS = np.zeros(6720, dtype=np.uint32)
+# The entry being written is never evicted for its own size, so the total may exceed the budget by one entry.
+MAX_ENTRY_BYTES = S.nbytes + ANS.nbytes + ENTRY_OVERHEAD_BYTES
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run_transaction(store, orphan):
+    # One query's life on Server2: s and ans arrive, verification frees them, the filter is downloaded. An
+    # orphan's ans never arrives, so only the TTL or the byte budget can reclaim it.
+    transaction_id = str(uuid.uuid4())
+    store.put(transaction_id, 's', S.copy())
+    if orphan: return
+    store.put(transaction_id, 'ans', ANS.copy())
+    # Under budget pressure s can already have been evicted again.
+    if not store.wait_for(transaction_id, ('s', 'ans'), timeout=1): return
+    with store.lock(transaction_id):
+        store.discard(transaction_id, 's', 'ans')
+        store.update(transaction_id, {'decryption_time': 0.0, 'membership_filter': bytes(88),
+                                      'recovered_items_hex': ['00' * 32] * 4})
+    store.pop(transaction_id, 'membership_filter')
+
+
+def test_soak_stays_within_byte_budget_and_ttl():
+    clock = FakeClock()
+    store = TransactionStore(ttl=TTL, max_bytes=MAX_BYTES, clock=clock)
+    rng = np.random.default_rng(0)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        # Steady batches are reclaimed by the TTL; every fifth is a burst only eviction can keep in budget.
+        for i in range(20):
+            orphans = rng.random(600 if i % 5 == 0 else 100) < 0.1
+            list(pool.map(lambda orphan: run_transaction(store, orphan), orphans))
+            stats = store.stats()
+            assert stats['bytes_held'] <= MAX_BYTES + MAX_ENTRY_BYTES
+            clock.now += TTL / 2
+    stats = store.stats()
+    assert stats['evictions'] > 0 and stats['expirations'] > 0
+    clock.now += TTL
+    stats = store.stats()
+    assert stats['live_entries'] == 0 and stats['bytes_held'] == 0
+
+
+def test_wait_for_is_released_by_cancel_key():
+    store = TransactionStore(ttl=TTL, max_bytes=MAX_BYTES)
+    store.put('t', 's', S.copy())
+    store.put('t', 'aborted', True)
+    assert not store.wait_for('t', ('s', 'ans'), timeout=5, cancel_key='aborted')
+
+
+def test_expired_entry_is_gone():
+    clock = FakeClock()
+    store = TransactionStore(ttl=TTL, max_bytes=MAX_BYTES, clock=clock)
+    store.put('t', 's', S.copy())
+    clock.now += TTL / 2
+    store.put('t', 'ans', ANS.copy())
+    clock.now += TTL / 2 + 0.1
+    # Writing ans refreshed the entry's expiry.
+    assert store.stats()['expirations'] == 0 and store.get('t', 's') is not None
+    clock.now += TTL
+    assert store.stats()['expirations'] == 1 and store.get('t', 's') is None
@@ -0,0 +1,151 @@
+# test_update.py (/update patches the snapshot in place; the result must equal a full rebuild's hint)
+import os
+
+import flask
+import numpy as np
+import pytest
+
+import query_pool
+import server1
+import shared_logic
+
+NUM_ENTRIES = 2000
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # A preprocessed Server1 whose snapshots, config and compaction state are private to the test.
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server1.app, 'config', flask.Config(server1.app.root_path, server1.app.config))
+    monkeypatch.setattr(server1, 'COMPACTION', {'thread': None, 'queued': [], 'failures': 0, 'last_error': None})
+    test_client = server1.app.test_client()
+    resp = test_client.post('/preprocess', json={'num_entries': NUM_ENTRIES, 'hash_len': 32})
+    assert resp.status_code == 200
+    return test_client
+
+
+def served_hint():
+    return np.load(os.path.join(server1.app.config['SNAPSHOT_DIR'], server1.HINT_FILE))
+
+
+def assert_hint_matches_rebuild():
+    expected = server1.compute_hint(server1.app.config['LWE_SEED'], np.asarray(server1.app.config['DB_MATRIX']))
+    assert np.array_equal(served_hint(), expected)
+    assert server1.load_snapshot(server1.app.config['SNAPSHOT_DIR'], verify=True) is not None
+
+
+def served_items():
+    return {row.tobytes() for row in server1.current_items(server1.app.config['SNAPSHOT_DIR'])}
+
+
+def prefix_of(item):
+    return int(shared_logic.prefix_values(item[None], server1.app.config['DB_PARAMS']['prefix_bits'])[0])
+
+
+def item_with_prefix(prefix):
+    # A random item whose prefix is `prefix`, as stored in PREFIX_LIST.
+    nbytes = shared_logic.prefix_nbytes(server1.app.config['DB_PARAMS']['prefix_bits'])
+    return np.frombuffer(prefix.to_bytes(nbytes, 'big') + os.urandom(32 - nbytes), dtype=np.uint8)
+
+
+def recovered_items(item):
+    # What Server2 would recover for a query on item's row: qu·DB minus s·hint, rounded to the row's slots.
+    row = [int(p, 16) for p in server1.app.config['PREFIX_LIST']].index(prefix_of(item))
+    db_matrix = server1.app.config['DB_MATRIX']
+    s, masked = query_pool.make_query_material(server1.app.config['LWE_SEED'], db_matrix.shape[0])
+    ans = server1.compute_answers(query_pool.mask_to_query(masked, row)[None], db_matrix)[0]
+    s_hint = shared_logic.matvec_mod_q(s, shared_logic.prepare_mod_q_operand(served_hint()))
+    entry_len = server1.app.config['DB_PARAMS']['entry_vec_len']
+    slots = shared_logic.round_mod_q_to_p(shared_logic.sub_mod_q(ans, s_hint))[:len(ans) // entry_len * entry_len]
+    return {slot.tobytes() for slot in slots.reshape(-1, entry_len)}
+
+
+def update(client, added=(), removed=(), **extra):
+    resp = client.post('/update', json={'add': [bytes(h).hex() for h in added],
+                                        'remove': [bytes(h).hex() for h in removed], **extra})
+    assert resp.status_code in (200, 202), resp.json
+    return resp.json
+
+
+def wait_for_compaction():
+    while server1.COMPACTION['thread'] is not None: server1.COMPACTION['thread'].join()
+
+
+def test_in_place_update_matches_full_hint(client):
+    items = server1.current_items(server1.app.config['SNAPSHOT_DIR'])
+    removed = items[7].copy()
+    added = item_with_prefix(prefix_of(items[3]))
+    result = update(client, [added], [removed])
+    assert (result['added'], result['removed'], result['spill_rows'], result['deferred']) == (1, 1, 0, 0)
+    assert_hint_matches_rebuild()
+    assert added.tobytes() in served_items() and removed.tobytes() not in served_items()
+    assert added.tobytes() in recovered_items(added)
+    assert removed.tobytes() not in recovered_items(removed)
+
+
+def test_hint_delta_patches_old_hint(client):
+    build_epoch = server1.app.config['EPOCH']
+    old_hint = served_hint()
+    items = server1.current_items(server1.app.config['SNAPSHOT_DIR'])
+    update(client, [item_with_prefix(prefix_of(items[0]))], [items[1].copy()])
+    update(client, [], [items[2].copy()])
+    resp = client.get('/hint-delta', query_string={'since': build_epoch})
+    assert resp.status_code == 200
+    delta, meta = shared_logic.decode_array(resp.data)
+    columns = np.array(meta['columns'], dtype=np.int64)
+    old_hint[:, columns] = shared_logic.add_mod_q(old_hint[:, columns], delta, out=np.empty_like(delta))
+    assert meta['to_epoch'] == build_epoch + 2
+    assert np.array_equal(old_hint, served_hint())
+
+
+def test_spill_row_update_matches_full_hint(client):
+    # Items with the top bit clear leave half the prefixes free for an addition to open a spill row with.
+    items = shared_logic.generate_hash_database(NUM_ENTRIES, 32).copy()
+    items[:, 0] &= 0x7f
+    shared_logic.save_hash_file(f"database_{NUM_ENTRIES}.npy", items)
+    assert client.post('/preprocess', json={'num_entries': NUM_ENTRIES, 'hash_len': 32}).status_code == 200
+    prefix_bits = server1.app.config['DB_PARAMS']['prefix_bits']
+    unused_bits = 8 * shared_logic.prefix_nbytes(prefix_bits) - prefix_bits
+    used = {int(p, 16) for p in server1.app.config['PREFIX_LIST']}
+    free = next(v << unused_bits for v in range(2 ** prefix_bits) if v << unused_bits not in used)
+    num_rows = server1.app.config['DB_MATRIX'].shape[0]
+    added = item_with_prefix(free)
+    result = update(client, [added])
+    assert result['spill_rows'] == 1
+    assert server1.app.config['DB_MATRIX'].shape[0] == num_rows + 1
+    assert_hint_matches_rebuild()
+    assert added.tobytes() in recovered_items(added)
+
+
+def test_overflow_is_added_by_compaction(client):
+    row_counts = server1.app.config['ROW_COUNTS']
+    max_cols = server1.app.config['DB_PARAMS']['max_cols_per_row']
+    row = int(np.argmax(row_counts))
+    prefix = int(server1.app.config['PREFIX_LIST'][row], 16)
+    added = [item_with_prefix(prefix) for _ in range(max_cols - int(row_counts[row]) + 2)]
+    old_seed = server1.app.config['LWE_SEED']
+    result = update(client, added)
+    assert result['deferred'] > 0 and result['compacting']
+    wait_for_compaction()
+    assert server1.COMPACTION['last_error'] is None
+    assert server1.app.config['LWE_SEED'] != old_seed
+    assert all(item.tobytes() in served_items() for item in added)
+    assert_hint_matches_rebuild()
+    assert added[-1].tobytes() in recovered_items(added[-1])
+
+
+def test_failed_compaction_keeps_its_additions(client, monkeypatch):
+    monkeypatch.setattr(server1, 'COMPACTION_RETRY_DELAY', 0)
+    compact_snapshot, attempts = server1.compact_snapshot, []
+
+    def flaky_compaction(batches):
+        attempts.append(len(batches))
+        if len(attempts) == 1: raise OSError("disk full")
+        compact_snapshot(batches)
+    monkeypatch.setattr(server1, 'compact_snapshot', flaky_compaction)
+    added = item_with_prefix(prefix_of(server1.current_items(server1.app.config['SNAPSHOT_DIR'])[0]))
+    assert update(client, [added], compact=True)['compacting']
+    wait_for_compaction()
+    assert len(attempts) == 2 and server1.COMPACTION['failures'] == 1
+    assert added.tobytes() in served_items()
+    assert_hint_matches_rebuild()
@@ -0,0 +1,113 @@
+# transaction_store.py (Bounded, thread-safe per-transaction state for Server2)
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+# Rough cost of an entry's dicts and bookkeeping, charged on top of its values so many small entries still count.
+ENTRY_OVERHEAD_BYTES = 512
+
+def value_nbytes(value):
+    if isinstance(value, np.ndarray): return value.nbytes
+    if isinstance(value, (bytes, bytearray, str)): return len(value)
+    if isinstance(value, (list, tuple)): return sum(value_nbytes(v) for v in value)
+    return 8
+
+
+# Per-transaction key/value state with a TTL, a total byte budget and readiness waits. Entries are kept in
+# least-recently-written order and every write refreshes an entry's expiry, so expired entries are always at
+# the front; they are purged there, then the oldest are evicted while the byte total is over max_bytes.
+# Structural changes happen under one Condition, which also wakes wait_for(); lock(transaction_id)
+# additionally serialises the slow work done for a single transaction.
+class TransactionStore:
+    def __init__(self, ttl=60.0, max_bytes=256 * 2 ** 20, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._locks = {}
+        self._cond = threading.Condition()
+        self._bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _drop(self, transaction_id):
+        entry = self._entries.pop(transaction_id)
+        self._bytes -= entry['nbytes']
+        self._locks.pop(transaction_id, None)
+
+    def _enforce_limits(self):
+        now = self.clock()
+        while self._entries:
+            transaction_id, entry = next(iter(self._entries.items()))
+            if entry['expires'] > now: break
+            self._drop(transaction_id)
+            self.expirations += 1
+        # The entry just written is at the back and is never evicted for its own size.
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def put(self, transaction_id, key, value):
+        self.update(transaction_id, {key: value})
+
+    def update(self, transaction_id, values):
+        with self._cond:
+            entry = self._entries.get(transaction_id)
+            if entry is None:
+                entry = self._entries[transaction_id] = {'values': {}, 'nbytes': ENTRY_OVERHEAD_BYTES}
+                self._bytes += ENTRY_OVERHEAD_BYTES
+            for key, value in values.items():
+                old_nbytes = value_nbytes(entry['values'][key]) if key in entry['values'] else 0
+                entry['values'][key] = value
+                entry['nbytes'] += value_nbytes(value) - old_nbytes
+                self._bytes += value_nbytes(value) - old_nbytes
+            entry['expires'] = self.clock() + self.ttl
+            self._entries.move_to_end(transaction_id)
+            self._enforce_limits()
+            self._cond.notify_all()
+
+    def get(self, transaction_id, key, default=None):
+        with self._cond:
+            entry = self._entries.get(transaction_id)
+            return default if entry is None else entry['values'].get(key, default)
+
+    def pop(self, transaction_id, key, default=None):
+        with self._cond:
+            entry = self._entries.get(transaction_id)
+            if entry is None or key not in entry['values']: return default
+            value = entry['values'].pop(key)
+            entry['nbytes'] -= value_nbytes(value)
+            self._bytes -= value_nbytes(value)
+            return value
+
+    def discard(self, transaction_id, *keys):
+        for key in keys: self.pop(transaction_id, key)
+
+    def wait_for(self, transaction_id, keys, timeout, cancel_key=None):
+        # True once every key is present for transaction_id; False on timeout or as soon as cancel_key is set.
+        def settled():
+            entry = self._entries.get(transaction_id)
+            return entry is not None and (cancel_key in entry['values'] or all(key in entry['values'] for key in keys))
+        with self._cond:
+            if not self._cond.wait_for(settled, timeout=timeout): return False
+            return cancel_key not in self._entries[transaction_id]['values']
+
+    @contextmanager
+    def lock(self, transaction_id):
+        with self._cond:
+            transaction_lock = self._locks.get(transaction_id)
+            if transaction_lock is None:
+                transaction_lock = threading.Lock()
+                # Only live entries keep their lock, so unknown ids cannot grow _locks.
+                if transaction_id in self._entries: self._locks[transaction_id] = transaction_lock
+        with transaction_lock:
+            yield
+
+    def stats(self):
+        with self._cond:
+            self._enforce_limits()
+            return {'live_entries': len(self._entries), 'bytes_held': self._bytes, 'max_bytes': self.max_bytes,
+                    'evictions': self.evictions, 'expirations': self.expirations}